@@ -1,11 +1,12 @@
 import streamlit as st
-import cv2
-import numpy as np
 import os
 import base64
+import threading
 import traceback
 
-from color_analyzer import analyze_image_for_color
+# 分析まわり（cv2 / numpy / skimage を読み込む color_analyzer など）は使う関数の中で import する。
+# 起動画面は重い import を待たずに表示し、その間に start_warm_up() で読み込みと準備を済ませる。
+# （メモリの少ない環境では環境変数 PERSONAL_COLOR_WARM_UP=0 で事前準備を止め、最初の診断時に準備する）
 
 # --- ギャル文字変換の定義 ---
 GAL_CHAR_MAP = {
@@ -289,7 +290,27 @@ cosme5_base64, cosme5_mime = get_base64_image("images/cosme_flow_05.png")
 
 import streamlit.components.v1 as components
 
+@st.cache_resource
+def start_warm_up():
+    """分析モジュールの読み込みと LUT などの準備をバックグラウンドで始める（プロセスで 1 回）
+
+    環境変数 PERSONAL_COLOR_WARM_UP が "0" / "false" / "no" / "off" なら何もしない（None を返す）。
+    """
+    if os.environ.get("PERSONAL_COLOR_WARM_UP", "1").strip().lower() in ("0", "false", "no", "off"):
+        return None
+
+    def warm_up():
+        import result_cache  # noqa: F401  color_analyzer / image_ingest もここで読み込まれる
+        from color_analyzer import warm_up as warm_up_analyzer
+        warm_up_analyzer()
+
+    thread = threading.Thread(target=warm_up, name="analyzer-warm-up", daemon=True)
+    thread.start()
+    return thread
+
 def show_start_page():
+    start_warm_up()
+
     if not bg_base64 or not logo_base64 or \
         not deco1_base64 :
         st.error("⚠️ 画像ファイルの一部が見つからないか、Base64データが空です。ファイルパスを確認してください。")
@@ -609,6 +630,60 @@ def get_text_advice(season_str):
     """
 
 
+@st.cache_resource
+def get_shade_index():
+    """コスメ色カタログのインデックス（環境変数 PERSONAL_COLOR_SHADE_CATALOG で CSV を指定。未指定なら None）"""
+    catalogue_path = os.environ.get("PERSONAL_COLOR_SHADE_CATALOG")
+    if not catalogue_path or not os.path.exists(catalogue_path):
+        return None
+    from shade_index import load_shade_index
+    return load_shade_index(catalogue_path)
+
+def show_shade_recommendations(lab_data, season_key, k=4):
+    """肌の LAB とシーズン代表色に近いコスメ色をカテゴリごとに表示する"""
+    shade_index = get_shade_index()
+    if shade_index is None:
+        return
+
+    from color_analyzer import SEASONS
+
+    st.subheader(t("💄 あなたに近いコスメの色"))
+    palette = SEASONS.get(season_key.capitalize())
+    for category in shade_index.categories:
+        shades = shade_index.recommend(lab_data, palette, k=k, category=category)
+        st.markdown(f"**{category}**")
+        st.markdown(t("肌の色に近い色"))
+        st.markdown(generate_color_chips_html(shades["skin"]), unsafe_allow_html=True)
+        if shades.get("palette"):
+            st.markdown(t("シーズンの色に近い色"))
+            st.markdown(generate_color_chips_html(shades["palette"]), unsafe_allow_html=True)
+
+@st.cache_data(max_entries=32)
+def get_dominant_colors(image_bytes, k=5):
+    """アップロード画像の肌以外の主要色（髪・服・背景など）をカラーチップ用に返す"""
+    from color_analyzer import dominant_colors
+    from image_ingest import decode_upload
+
+    colors = dominant_colors(decode_upload(image_bytes), k=k)
+    return [{"name": f"{c['weight']:.0%}", "hex": c["hex"]} for c in colors]
+
+# 診断シーズン → COLOR_PALETTES のキー
+PALETTE_KEYS = {"spring": "イエベ春", "summer": "ブルベ夏", "autumn": "イエベ秋", "winter": "ブルベ冬"}
+
+@st.cache_data(max_entries=32)
+def get_draping_sheet(image_bytes, season_key):
+    """シーズンのパレット色でドレープしたコンタクトシート（RGB）と色名のリスト"""
+    palette = COLOR_PALETTES.get(PALETTE_KEYS.get(season_key, ""), [])
+    if not palette:
+        return None, []
+    from color_analyzer import draping_contact_sheet
+    from image_ingest import decode_upload
+
+    colors_bgr = [[int(c["hex"][i:i + 2], 16) for i in (5, 3, 1)] for c in palette]
+    sheet = draping_contact_sheet(decode_upload(image_bytes), colors_bgr)
+    return sheet[:, :, ::-1], [c["name"] for c in palette]
+
+
 # セッション状態の初期化
 if 'diagnosed_season' not in st.session_state:
     st.session_state.diagnosed_season = None
@@ -617,6 +692,9 @@ if 'coord_season_key' not in st.session_state:
 
 
 def show_diagnosis_page():
+    from color_analyzer import RECOMMENDED_MAX_PIXELS, ImageQualityError
+    from image_ingest import ImageRejectedError
+    from result_cache import shared_cache
 
     st.subheader(t("ステップ1: 写真を選ぶ"))
 
@@ -635,21 +713,17 @@ def show_diagnosis_page():
         st.info(t("写真をアップロードするか、カメラで撮影してください。"))
         return
 
-    # --- 入力された画像を OpenCV 形式へ変換 ---
-    if uploaded_image is not None:
-        file_bytes = np.asarray(bytearray(uploaded_image.read()), dtype=np.uint8)
-        img_bgr = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-
-    elif captured_image is not None:
-        file_bytes = np.asarray(bytearray(captured_image.read()), dtype=np.uint8)
-        img_bgr = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+    image_file = uploaded_image if uploaded_image is not None else captured_image
 
     # --- ステップ2: カラー分析 ---
     st.subheader(t("ステップ2: カラー分析の実行"))
 
     try:
+        # 同じ画像の再アップロードはキャッシュから返す（未登録ならヘッダー確認 → 縮小デコード → 画質チェック → 分析）
         with st.spinner(t("診断を実行中です...")):
-            season, lab_data, season_percentages = analyze_image_for_color(img_bgr)
+            season, lab_data, season_percentages = shared_cache.analyze_bytes(
+                image_file.getvalue(), max_pixels=RECOMMENDED_MAX_PIXELS, quality_gate=True
+            )
 
         st.success(t(f"🎉 カラー分析が完了しました！結果: {season}"))
 
@@ -657,10 +731,21 @@ def show_diagnosis_page():
         st.session_state.diagnosed_season = season
         st.session_state.lab_data = lab_data
         st.session_state.season_percentages = season_percentages
+        st.session_state.image_bytes = image_file.getvalue()
 
         st.session_state.page = "result"
         st.rerun()
 
+    except ImageRejectedError as e:
+        st.error(t(f"画像を読み込めませんでした。{e}"))
+        st.info(t("別の画像を選ぶか、撮り直して再度お試しください。"))
+
+    except ImageQualityError as e:
+        # 重い分析の前に弾いたので、すぐに撮り直してもらえる
+        st.warning(t("この写真では正しく診断できません。"))
+        for _, reason in e.quality.issues:
+            st.write(t(f"- {reason}"))
+
     except Exception as e:
         st.error(t(f"カラー分析ロジックの実行中にエラーが発生しました。エラー: {e}"))
         st.info(t("画像を撮り直して再度お試しください。"))
@@ -714,6 +799,17 @@ def show_result_page():
     }
 
     st.json(lab_LAB)
+
+    show_shade_recommendations(st.session_state.lab_data, season_key)
+
+    if st.session_state.get("image_bytes"):
+        st.subheader(t("👗 写真の主な色（髪・服など）"))
+        st.markdown(generate_color_chips_html(get_dominant_colors(st.session_state.image_bytes)), unsafe_allow_html=True)
+
+        drape_sheet, drape_names = get_draping_sheet(st.session_state.image_bytes, season_key)
+        if drape_sheet is not None:
+            st.subheader(t("🧣 ドレーププレビュー"))
+            st.image(drape_sheet, caption=" / ".join(drape_names), use_container_width=True)
     
     
     # ----------------------------------------------------
@@ -1,6 +1,13 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
-from skimage import color
 
 # --- シーズン代表色（改良版） ---
 SPRING_COLORS = np.array([
@@ -23,40 +30,1064 @@ SEASONS = {
     "Winter": WINTER_COLORS,
 }
 
+# 肌色の一般的範囲（YCrCb・安定度の高い推奨値）
+SKIN_YCRCB_LOWER = np.array([0, 133, 77], dtype=np.uint8)
+SKIN_YCRCB_UPPER = np.array([255, 173, 127], dtype=np.uint8)
 
-def analyze_image_for_color(img_bgr):
-    """肌色抽出→LAB平均→4シーズン距離→季節とLAB返却"""
+# 肌が取れない場合に全体で代用するしきい値（画素数）
+MIN_SKIN_PIXELS = 50
 
-    # ==============================
-    # 🟡 ① 肌色領域の抽出（YCrCbマスク）
-    # ==============================
-    img_ycrcb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2YCrCb)
-    y, cr, cb = cv2.split(img_ycrcb)
 
-    # 肌色の一般的範囲（安定度の高い推奨値）
-    lower = np.array([0, 133, 77], dtype=np.uint8)
-    upper = np.array([255, 173, 127], dtype=np.uint8)
-    mask = cv2.inRange(img_ycrcb, lower, upper)
+# ==============================
+# 📏 CIEDE2000 色差（ベクトル化・float32）
+# ==============================
+class Ciede2000Reference:
+    """CIEDE2000 の参照色側だけで決まる項（L, a, b, 彩度 C）を前計算したもの
 
-    skin_pixels = img_bgr[mask > 0]
+    シーズン代表色のように固定の参照色に何度も距離を測るときに使い回す。
+    """
 
-    if len(skin_pixels) < 50:
-        # 肌が全然取れない場合 → 全体で代用（最低限の処理）
-        skin_pixels = img_bgr.reshape(-1, 3)
+    def __init__(self, lab):
+        lab = np.asarray(lab, dtype=np.float32).reshape(-1, 3)
+        self.L = lab[:, 0][np.newaxis, :]
+        self.a = lab[:, 1][np.newaxis, :]
+        self.b = lab[:, 2][np.newaxis, :]
+        self.C = np.hypot(self.a, self.b)
+        self.b_sq = self.b * self.b
 
-    # ==============================
-    # 🔵 ② 肌色を LAB に変換して平均
-    # ==============================
-    skin_lab = color.rgb2lab(skin_pixels[:, ::-1] / 255.0)  # BGR→RGB
-    mean_lab = np.mean(skin_lab, axis=0)
+
+def delta_e_ciede2000(lab, reference):
+    """(N, 3) の LAB と (M, 3) の参照色（または Ciede2000Reference）→ (N, M) の ΔE2000（float32）
+
+    Sharma ら (2005) の式をそのまま配列演算にしたもの（kL = kC = kH = 1）。
+    skimage.color.deltaE_ciede2000 との差は float32 の丸め程度（1e-3 未満）。
+    """
+    if not isinstance(reference, Ciede2000Reference):
+        reference = Ciede2000Reference(reference)
+    lab = np.asarray(lab, dtype=np.float32).reshape(-1, 3)
+    L1, a1, b1 = lab[:, 0:1], lab[:, 1:2], lab[:, 2:3]
+    L2, a2, b2 = reference.L, reference.a, reference.b
+
+    # --- a' と C', h' ---
+    c_bar7 = ((np.hypot(a1, b1) + reference.C) * np.float32(0.5)) ** 7
+    g = np.float32(0.5) * (1 - np.sqrt(c_bar7 / (c_bar7 + np.float32(25.0 ** 7))))
+    a1p = (1 + g) * a1
+    a2p = (1 + g) * a2
+    c1p = np.sqrt(a1p * a1p + b1 * b1)
+    c2p = np.sqrt(a2p * a2p + reference.b_sq)
+    two_pi = np.float32(2 * np.pi)
+    h1p = np.arctan2(b1, a1p) % two_pi
+    h2p = np.arctan2(b2, a2p) % two_pi
+
+    # --- ΔL', ΔC', ΔH' ---
+    c_prod = c1p * c2p
+    dhp = h2p - h1p
+    dhp = np.where(dhp > np.pi, dhp - two_pi, np.where(dhp < -np.pi, dhp + two_pi, dhp))
+    dhp = np.where(c_prod == 0, 0, dhp)
+    dLp = L2 - L1
+    dCp = c2p - c1p
+    dHp = 2 * np.sqrt(c_prod) * np.sin(dhp * np.float32(0.5))
+
+    # --- 平均の L', C', h' ---
+    l_bar = (L1 + L2) * np.float32(0.5) - 50
+    c_barp = (c1p + c2p) * np.float32(0.5)
+    h_sum = h1p + h2p
+    h_barp = np.where(
+        np.abs(h1p - h2p) <= np.pi, h_sum * np.float32(0.5),
+        np.where(h_sum < two_pi, (h_sum + two_pi) * np.float32(0.5), (h_sum - two_pi) * np.float32(0.5)),
+    )
+    h_barp = np.where(c_prod == 0, h_sum, h_barp)
+
+    # --- 重み関数と回転項 ---
+    deg = np.float32(np.pi / 180)
+    t = (1 - np.float32(0.17) * np.cos(h_barp - 30 * deg) + np.float32(0.24) * np.cos(2 * h_barp)
+         + np.float32(0.32) * np.cos(3 * h_barp + 6 * deg) - np.float32(0.20) * np.cos(4 * h_barp - 63 * deg))
+    d_theta = 30 * deg * np.exp(-(((h_barp / deg) - 275) / 25) ** 2)
+    c_barp7 = c_barp ** 7
+    r_c = 2 * np.sqrt(c_barp7 / (c_barp7 + np.float32(25.0 ** 7)))
+    s_l = 1 + np.float32(0.015) * l_bar * l_bar / np.sqrt(20 + l_bar * l_bar)
+    s_c = 1 + np.float32(0.045) * c_barp
+    s_h = 1 + np.float32(0.015) * c_barp * t
+    r_t = -np.sin(2 * d_theta) * r_c
+
+    dl = dLp / s_l
+    dc = dCp / s_c
+    dh = dHp / s_h
+    return np.sqrt(np.maximum(dl * dl + dc * dc + dh * dh + r_t * dc * dh, 0)).astype(np.float32)
+
+
+# ==============================
+# 🗂️ シーズン判定モデル
+# ==============================
+class SeasonModel:
+    """全シーズンの代表色を 1 つの連続配列 (K, 3) にまとめた判定モデル
+
+    segment[k] が k 番目の代表色の属するシーズン番号、offsets / sizes が各シーズンの区間。
+    距離は (N 画像 × K 色) を一度にブロードキャストで求め、区間ごとに平均する。
+    12 / 16 シーズンのように代表色が多くても Python のループはない。
+    検証はモデルを作るとき（ファイル読み込み時）に 1 度だけ行う。
+    metric: "euclidean"（LAB のユークリッド距離・従来）/ "ciede2000"（ΔE2000）
+    """
+
+    METRICS = ("euclidean", "ciede2000")
+
+    # 一度に距離を計算する画像数（N × K × 3 の一時配列を抑える）
+    CHUNK = 4096
+
+    def __init__(self, palettes, name=None, metric="euclidean"):
+        if metric not in self.METRICS:
+            raise ValueError(f"未対応の距離です: {metric}（{', '.join(self.METRICS)}）")
+        if not palettes:
+            raise ValueError("シーズンが 1 つもありません")
+        names, blocks = [], []
+        for season, colors in palettes.items():
+            colors = np.asarray(colors, dtype=np.float64)
+            if colors.ndim != 2 or colors.shape[1] != 3 or len(colors) == 0:
+                raise ValueError(f"{season}: 代表色は (色数, 3) の LAB 配列で指定してください")
+            if not np.isfinite(colors).all():
+                raise ValueError(f"{season}: 代表色に数値以外が含まれています")
+            if (colors[:, 0] < 0).any() or (colors[:, 0] > 100).any():
+                raise ValueError(f"{season}: L は 0〜100 の範囲で指定してください")
+            names.append(str(season))
+            blocks.append(colors)
+
+        self.name = name
+        self.metric = metric
+        self.names = names
+        self.colors = np.ascontiguousarray(np.concatenate(blocks))
+        self.sizes = np.array([len(b) for b in blocks])
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+        self.segment = np.repeat(np.arange(len(names)), self.sizes)
+        self._colors_sq = (self.colors ** 2).sum(axis=1)
+        self._ciede_reference = Ciede2000Reference(self.colors) if metric == "ciede2000" else None
+
+    @classmethod
+    def load(cls, path):
+        """JSON ファイル {"name": ..., "metric": ..., "seasons": {"シーズン名": [[L, a, b], ...], ...}} から読み込む"""
+
+        def no_duplicates(pairs):
+            keys = [k for k, _ in pairs]
+            duplicated = {k for k in keys if keys.count(k) > 1}
+            if duplicated:
+                raise ValueError(f"シーズン名が重複しています: {', '.join(sorted(duplicated))}")
+            return dict(pairs)
+
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f, object_pairs_hook=no_duplicates)
+        return cls(data["seasons"], name=data.get("name"), metric=data.get("metric", "euclidean"))
+
+    def __repr__(self):
+        # 結果キャッシュのキーに使えるよう、内容が同じなら同じ文字列になる
+        digest = hashlib.blake2b(self.colors.tobytes() + "\0".join(self.names).encode(), digest_size=8)
+        return f"SeasonModel({self.name!r}, {len(self.names)} seasons, {self.metric}, {digest.hexdigest()})"
+
+    def distances(self, mean_labs):
+        """(N, 3) の LAB 平均 → (N, S) の各シーズン代表色との平均距離"""
+        mean_labs = np.asarray(mean_labs, dtype=np.float64).reshape(-1, 3)
+        out = np.empty((len(mean_labs), len(self.names)))
+        for start in range(0, len(mean_labs), self.CHUNK):
+            chunk = mean_labs[start:start + self.CHUNK]
+            if self._ciede_reference is not None:
+                d = delta_e_ciede2000(chunk, self._ciede_reference)
+                out[start:start + len(chunk)] = np.add.reduceat(d, self.offsets, axis=1) / self.sizes
+                continue
+            # |m - c|² = |m|² + |c|² - 2 m·c（内積は行列積 1 回で全組み合わせを計算）
+            d = chunk @ (-2 * self.colors.T)
+            d += (chunk ** 2).sum(axis=1)[:, np.newaxis]
+            d += self._colors_sq
+            np.maximum(d, 0, out=d)
+            np.sqrt(d, out=d)
+            out[start:start + len(chunk)] = np.add.reduceat(d, self.offsets, axis=1) / self.sizes
+        return out
+
+    @staticmethod
+    def percentages(distances):
+        """距離行列 (N, S) → 適合度（％）行列 (N, S)"""
+        inv_scores = 1 / (1 + distances)
+        return np.round(inv_scores / inv_scores.sum(axis=1, keepdims=True) * 100, 2)
+
+    def score(self, mean_labs):
+        """(N, 3) → (一番近いシーズン番号 (N,), 距離 (N, S), 適合度％ (N, S))"""
+        distances = self.distances(mean_labs)
+        return np.argmin(distances, axis=1), distances, self.percentages(distances)
+
+
+_default_model = (None, None)
+
+
+def default_season_model():
+    """現在の SEASONS から作ったモデル（SEASONS が書き換えられたら作り直す）"""
+    global _default_model
+    key = tuple((name, np.asarray(colors).tobytes()) for name, colors in SEASONS.items())
+    cached_key, model = _default_model
+    if cached_key != key:
+        model = SeasonModel(SEASONS, name="default")
+        _default_model = (key, model)
+    return model
+
+
+# ==============================
+# 🟤 BGR→LAB ルックアップテーブル
+# ==============================
+# 1 エントリ (uint32) = L8 | a8 << 8 | b8 << 16 | 肌フラグ << 24
+#   L8 = round(L * 255 / 100), a8 = round(a + 128), b8 = round(b + 128)（OpenCV の 8bit LAB と同じ符号化）
+# 量子化誤差は 1 画素あたり ΔE76 ≤ 0.74（L: 0.2, a/b: 0.5 の丸め）。
+# 平均 LAB では丸め誤差がほぼ相殺され、実画像で 0.01 程度。
+LAB_LUT_MAX_DELTA_E = 0.74
+
+# skimage.color.rgb2lab と同じ定数（D65, 2°）
+_SRGB_TO_XYZ = np.array([
+    [0.412453, 0.357580, 0.180423],
+    [0.212671, 0.715160, 0.072169],
+    [0.019334, 0.119193, 0.950227],
+])
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def _bgr_to_lab_float32(pixels_bgr):
+    """(N, 3) uint8 BGR → (N, 3) float32 LAB（LUT 構築用の高速版）"""
+    v = np.arange(256) / 255.0
+    linear = np.where(v > 0.04045, ((v + 0.055) / 1.055) ** 2.4, v / 12.92).astype(np.float32)
+    # 白色点で正規化し、列を BGR 順に並べ替えた変換行列
+    m = (_SRGB_TO_XYZ / _D65_WHITE[:, np.newaxis])[:, ::-1].astype(np.float32)
+
+    xyz = linear[pixels_bgr] @ m.T
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack([
+        116 * f[:, 1] - 16,
+        500 * (f[:, 0] - f[:, 1]),
+        200 * (f[:, 1] - f[:, 2]),
+    ], axis=1)
+
+
+class LabLookupTable:
+    """24bit BGR 値 → 8bit LAB + 肌判定 を 1 回の参照で返す共有テーブル（64MB）"""
+
+    def __init__(self, table):
+        self.table = table
+
+    @classmethod
+    def build(cls):
+        """全 1677 万色を B のスライスごとに変換して構築（約 0.6 秒）"""
+        table = np.empty(1 << 24, dtype=np.uint32)
+        g, b = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing="ij")
+        # キー = B | G << 8 | R << 16（リトルエンディアンの BGRA を uint32 として見た下位 24bit）
+        for r in range(256):
+            slab = np.stack([b, g, np.full_like(g, r)], axis=-1).reshape(-1, 3)
+            lab = _bgr_to_lab_float32(slab)
+            l8 = np.clip(np.rint(lab[:, 0] * 255 / 100), 0, 255).astype(np.uint32)
+            a8 = np.clip(np.rint(lab[:, 1] + 128), 0, 255).astype(np.uint32)
+            b8 = np.clip(np.rint(lab[:, 2] + 128), 0, 255).astype(np.uint32)
+
+            # 肌判定は通常経路と同じ cvtColor + inRange で求める（完全一致）
+            ycrcb = cv2.cvtColor(slab.reshape(1, -1, 3), cv2.COLOR_BGR2YCrCb)
+            skin = (cv2.inRange(ycrcb, SKIN_YCRCB_LOWER, SKIN_YCRCB_UPPER).ravel() > 0).astype(np.uint32)
+
+            table[r << 16:(r + 1) << 16] = l8 | (a8 << 8) | (b8 << 16) | (skin << 24)
+        return cls(table)
+
+    @classmethod
+    def load(cls, path):
+        """save() したテーブルをメモリマップで読み込む（プロセス間でページを共有）"""
+        return cls(np.load(path, mmap_mode="r"))
+
+    def save(self, path):
+        np.save(path, np.asarray(self.table))
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+    def lookup(self, img_bgr):
+        """BGR 画素（任意形状 (..., 3)）→ 1 次元のエントリ配列"""
+        p = np.ascontiguousarray(img_bgr, dtype=np.uint8).reshape(1, -1, 3)
+        keys = cv2.cvtColor(p, cv2.COLOR_BGR2BGRA).view(np.uint32).ravel()
+        np.bitwise_and(keys, 0xFFFFFF, out=keys)
+        return self.table[keys]
+
+    @staticmethod
+    def skin_mask(entries):
+        return (entries >> 24).astype(bool)
+
+    @staticmethod
+    def decode(entries):
+        """エントリ → (N, 3) float64 LAB"""
+        return np.stack([
+            (entries & 0xFF) * (100 / 255),
+            ((entries >> 8) & 0xFF).astype(np.float64) - 128,
+            ((entries >> 16) & 0xFF).astype(np.float64) - 128,
+        ], axis=1)
+
+    @staticmethod
+    def channel_sums(entries):
+        """エントリ → 符号化 LAB の合計 (3,)（平均はこれを decode_mean で戻す）"""
+        return np.array([
+            np.sum(entries & 0xFF, dtype=np.int64),
+            np.sum((entries >> 8) & 0xFF, dtype=np.int64),
+            np.sum((entries >> 16) & 0xFF, dtype=np.int64),
+        ], dtype=np.float64)
+
+    @staticmethod
+    def decode_mean(sums, count):
+        """符号化 LAB の合計 (..., 3) と画素数 → 平均 LAB（符号化はアフィンなので合計後に戻せる）"""
+        mean = np.asarray(sums, dtype=np.float64) / np.asarray(count, dtype=np.float64)[..., np.newaxis]
+        return mean * np.array([100 / 255, 1.0, 1.0]) - np.array([0.0, 128.0, 128.0])
+
+    def mean_lab(self, entries):
+        return self.decode_mean(self.channel_sums(entries), len(entries))
+
+
+class SkinLabSums:
+    """肌画素数と符号化 LAB の合計（帯やフレームごとの部分和。整数なので足し合わせても誤差なし）"""
+
+    def __init__(self, n_pixels=0, skin_count=0, all_sums=None, skin_sums=None):
+        self.n_pixels = n_pixels
+        self.skin_count = skin_count
+        self.all_sums = np.zeros(3, dtype=np.int64) if all_sums is None else all_sums
+        self.skin_sums = np.zeros(3, dtype=np.int64) if skin_sums is None else skin_sums
+
+    @classmethod
+    def from_entries(cls, entries):
+        """LUT エントリ（1 次元・連続）から部分和を作る（entries は書き換える）"""
+        n = len(entries)
+        planes = entries.view(np.uint8).reshape(n, 4)
+        all_sums = np.array([planes[:, c].sum(dtype=np.int64) for c in range(3)])
+
+        skin = entries >= (1 << 24)
+        # 肌以外のエントリを 0 にして合計から外す
+        np.multiply(entries, skin, out=entries)
+        skin_sums = np.array([planes[:, c].sum(dtype=np.int64) for c in range(3)])
+        return cls(n, int(np.count_nonzero(skin)), all_sums, skin_sums)
+
+    def __add__(self, other):
+        return SkinLabSums(
+            self.n_pixels + other.n_pixels,
+            self.skin_count + other.skin_count,
+            self.all_sums + other.all_sums,
+            self.skin_sums + other.skin_sums,
+        )
+
+    def mean_lab(self):
+        if self.skin_count < MIN_SKIN_PIXELS:
+            # 肌が全然取れない場合 → 全体で代用（最低限の処理）
+            return LabLookupTable.decode_mean(self.all_sums, self.n_pixels)
+        return LabLookupTable.decode_mean(self.skin_sums, self.skin_count)
+
+
+_lab_lut = None
+_lab_lut_lock = threading.Lock()
+
+
+def get_lab_lut():
+    """プロセス内で共有する LabLookupTable（初回呼び出し時に 1 度だけ構築）"""
+    global _lab_lut
+    if _lab_lut is None:
+        with _lab_lut_lock:
+            if _lab_lut is None:
+                _lab_lut = LabLookupTable.build()
+    return _lab_lut
+
+
+# ==============================
+# 🧩 肌領域抽出のバックエンド
+# ==============================
+class SkinSegmenter:
+    """肌領域抽出のバックエンド。mask() は画像と同じ高さ・幅の 0/255 の uint8 マスクを返す
+
+    どのバックエンドも画素ごとの判定なので、(1, N, 3) に並べた画素列にもそのまま使える。
+    """
+
+    name = None
+
+    def mask(self, img_bgr):
+        raise NotImplementedError
+
+
+class YCrCbRangeSegmenter(SkinSegmenter):
+    """YCrCb の範囲判定（従来の方式）"""
+
+    name = "ycrcb"
+
+    def __init__(self, lower=SKIN_YCRCB_LOWER, upper=SKIN_YCRCB_UPPER):
+        self.lower = np.asarray(lower, dtype=np.uint8)
+        self.upper = np.asarray(upper, dtype=np.uint8)
+
+    def mask(self, img_bgr):
+        return cv2.inRange(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2YCrCb), self.lower, self.upper)
+
+
+class HSVRangeSegmenter(SkinSegmenter):
+    """HSV の範囲判定（H: 0〜50°, S: 0.23〜0.68, V ≥ 0.35。OpenCV の 8bit HSV の値で指定）"""
+
+    name = "hsv"
+
+    def __init__(self, lower=(0, 58, 89), upper=(25, 173, 255)):
+        self.lower = np.asarray(lower, dtype=np.uint8)
+        self.upper = np.asarray(upper, dtype=np.uint8)
+
+    def mask(self, img_bgr):
+        return cv2.inRange(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2HSV), self.lower, self.upper)
+
+
+class GaussianSkinSegmenter(SkinSegmenter):
+    """CrCb 平面の 2 次元ガウス分布による肌らしさ（マハラノビス距離² が threshold 以下を肌とする）
+
+    既定値は同梱モデル写真の頬・額の画素（無彩色に近い画素を除く）に当てはめたもの。
+    """
+
+    name = "gaussian"
+
+    def __init__(self, mean=(148.0, 113.4), cov=((46.4, -38.0), (-38.0, 56.7)), threshold=6.0):
+        self.mean = np.asarray(mean, dtype=np.float32)            # (Cr, Cb)
+        self.inv_cov = np.linalg.inv(np.asarray(cov)).astype(np.float32)
+        self.threshold = threshold
+
+    def distance_sq(self, cr, cb):
+        dcr = np.asarray(cr, dtype=np.float32) - self.mean[0]
+        dcb = np.asarray(cb, dtype=np.float32) - self.mean[1]
+        ic = self.inv_cov
+        return ic[0, 0] * dcr * dcr + 2 * ic[0, 1] * dcr * dcb + ic[1, 1] * dcb * dcb
+
+    def mask(self, img_bgr):
+        ycrcb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2YCrCb)
+        skin = self.distance_sq(ycrcb[..., 1], ycrcb[..., 2]) <= self.threshold
+        return skin.astype(np.uint8) * 255
+
+    def crcb_table(self):
+        """(Cr, Cb) の全 65536 通りを判定した 256x256 テーブル"""
+        cr, cb = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+        return (self.distance_sq(cr, cb) <= self.threshold).astype(np.uint8) * 255
+
+
+class CrCbLookupSegmenter(SkinSegmenter):
+    """(Cr, Cb) → 肌判定 の 256x256 テーブル参照（既定はガウスモデルを事前計算したもの）"""
+
+    name = "crcb_lut"
+
+    def __init__(self, table=None):
+        if table is None:
+            table = GaussianSkinSegmenter().crcb_table()
+        self.table = np.ascontiguousarray(table, dtype=np.uint8).reshape(-1)
+
+    def mask(self, img_bgr):
+        ycrcb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2YCrCb)
+        index = ycrcb[..., 1].astype(np.uint16) << 8
+        index |= ycrcb[..., 2]
+        return self.table[index]
+
+
+SKIN_BACKENDS = {
+    cls.name: cls
+    for cls in (YCrCbRangeSegmenter, HSVRangeSegmenter, GaussianSkinSegmenter, CrCbLookupSegmenter)
+}
+
+_skin_backend_instances = {}
+
+
+def get_skin_backend(backend="ycrcb"):
+    """名前（SKIN_BACKENDS のキー）または SkinSegmenter → SkinSegmenter（名前ごとに 1 つを共有）"""
+    if isinstance(backend, SkinSegmenter):
+        return backend
+    if backend not in SKIN_BACKENDS:
+        raise ValueError(f"未対応の肌抽出バックエンドです: {backend}（{', '.join(SKIN_BACKENDS)}）")
+    if backend not in _skin_backend_instances:
+        _skin_backend_instances[backend] = SKIN_BACKENDS[backend]()
+    return _skin_backend_instances[backend]
+
+
+def _uses_lut_skin_flag(backend):
+    """LabLookupTable に焼き込んだ肌フラグ（既定の YCrCb 範囲）をそのまま使えるか"""
+    return (
+        isinstance(backend, YCrCbRangeSegmenter)
+        and np.array_equal(backend.lower, SKIN_YCRCB_LOWER)
+        and np.array_equal(backend.upper, SKIN_YCRCB_UPPER)
+    )
+
+
+def _lookup_skin_entries(lut, img_bgr, backend):
+    """LUT エントリ（肌フラグは backend の判定に差し替える）"""
+    entries = lut.lookup(img_bgr)
+    if not _uses_lut_skin_flag(backend):
+        skin = backend.mask(np.ascontiguousarray(img_bgr, dtype=np.uint8).reshape(1, -1, 3)).ravel()
+        np.bitwise_and(entries, 0xFFFFFF, out=entries)
+        entries |= (skin > 0).astype(np.uint32) << 24
+    return entries
+
+
+def measure_skin_stats(img_bgr, max_pixels=None, skin_backend="ycrcb", hist_bins=None):
+    """LUT で画像 1 枚の肌統計を求める → (SkinLabSums, ヒストグラム or None)
+
+    sums.mean_lab() は analyze_image_for_color（mode="pixels", lab_engine="lut"）の LAB 平均と一致する。
+    hist_bins（256 の約数）を渡すと、平均に使った画素（肌が足りなければ全画素）の
+    符号化 LAB の粗いヒストグラム (hist_bins, hist_bins, hist_bins) uint32 も返す。
+    """
+    img_bgr, _ = limit_resolution(img_bgr, max_pixels)
+    entries = _lookup_skin_entries(get_lab_lut(), img_bgr, get_skin_backend(skin_backend))
+
+    hist = None
+    if hist_bins:
+        if 256 % hist_bins:
+            raise ValueError(f"hist_bins は 256 の約数にしてください: {hist_bins}")
+        skin = entries[entries >= (1 << 24)]
+        used = skin if len(skin) >= MIN_SKIN_PIXELS else entries
+        width = 256 // hist_bins
+        index = (((used & 0xFF) // width) * hist_bins + ((used >> 8) & 0xFF) // width) * hist_bins \
+            + ((used >> 16) & 0xFF) // width
+        hist = np.bincount(index, minlength=hist_bins ** 3).astype(np.uint32).reshape((hist_bins,) * 3)
+
+    return SkinLabSums.from_entries(entries), hist
+
+
+def benchmark_skin_backends(images, names=None, repeat=3):
+    """各バックエンドの処理速度と、バックエンド同士のマスクの一致度を同じ画像セットで測る
+
+    戻り値: {"backends": {名前: {"mpix_per_s", "coverage"}},
+             "agreement": {(名前A, 名前B): {"pixel", "iou"}}}
+    """
+    names = list(names or SKIN_BACKENDS)
+    total_pixels = sum(img.shape[0] * img.shape[1] for img in images)
+    masks = {}
+    backends = {}
+    for name in names:
+        backend = get_skin_backend(name)
+        backend.mask(images[0])  # テーブル構築などの初回コストを外す
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = [backend.mask(img) > 0 for img in images]
+            best = min(best, time.perf_counter() - start)
+        masks[name] = result
+        skin = sum(int(np.count_nonzero(m)) for m in result)
+        backends[name] = {"mpix_per_s": total_pixels / 1e6 / best, "coverage": skin / total_pixels}
+
+    agreement = {}
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            same = sum(int(np.count_nonzero(ma == mb)) for ma, mb in zip(masks[a], masks[b]))
+            both = sum(int(np.count_nonzero(ma & mb)) for ma, mb in zip(masks[a], masks[b]))
+            either = sum(int(np.count_nonzero(ma | mb)) for ma, mb in zip(masks[a], masks[b]))
+            agreement[(a, b)] = {"pixel": same / total_pixels, "iou": both / either if either else 1.0}
+    return {"backends": backends, "agreement": agreement}
+
+
+# ==============================
+# 🟢 ヒストグラム領域での分析
+# ==============================
+# 肌画素の BGR 3 次元ヒストグラムを作り、使われているビンの中心色だけを LAB に変換する。
+# 変換コストは画素数ではなく色の種類（占有ビン数）で決まる。
+DEFAULT_HIST_BINS = 32
+
+
+class SkinHistogram:
+    """肌色の BGR ヒストグラム（占有ビンのみ）と各ビン中心の LAB"""
+
+    def __init__(self, bins, bgr, counts):
+        self.bins = bins
+        self.bgr = bgr          # (K, 3) ビン中心の BGR 値
+        self.counts = counts    # (K,) 各ビンの画素数
+        from skimage import color  # 読み込みが重いので使うときだけ（warm_up で先に読み込める）
+
+        self.lab = color.rgb2lab(bgr[np.newaxis, :, ::-1] / 255.0)[0] if len(bgr) else np.empty((0, 3))
+
+    @classmethod
+    def from_bgr_histogram(cls, hist):
+        """cv2.calcHist の (bins, bins, bins) 出力から作成"""
+        bins = hist.shape[0]
+        occupied = np.nonzero(hist)
+        width = 256 / bins
+        bgr = (np.stack(occupied, axis=1) + 0.5) * width - 0.5
+        return cls(bins, bgr, hist[occupied].astype(np.float64))
+
+    @property
+    def total(self):
+        return float(self.counts.sum())
+
+    def mean(self):
+        return (self.lab * self.counts[:, np.newaxis]).sum(axis=0) / self.total
+
+    def percentile(self, q):
+        """チャンネルごとの重み付きパーセンタイル（q: 0〜100）→ (3,)"""
+        result = np.empty(3)
+        for c in range(3):
+            order = np.argsort(self.lab[:, c], kind="stable")
+            cum = np.cumsum(self.counts[order])
+            idx = np.searchsorted(cum, q / 100 * cum[-1], side="left")
+            result[c] = self.lab[order[min(idx, len(order) - 1)], c]
+        return result
+
+    def median(self):
+        return self.percentile(50)
+
+
+def skin_histogram(img_bgr, bins=DEFAULT_HIST_BINS, skin_backend="ycrcb"):
+    """肌マスクで絞った肌画素の SkinHistogram（肌が取れない場合は全体）"""
+    mask = get_skin_backend(skin_backend).mask(img_bgr)
+    if cv2.countNonZero(mask) < MIN_SKIN_PIXELS:
+        mask = None
+    hist = cv2.calcHist([img_bgr], [0, 1, 2], mask, [bins] * 3, [0, 256] * 3)
+    return SkinHistogram.from_bgr_histogram(hist)
+
+
+# ==============================
+# 🙂 顔領域の検出（OpenCV 同梱の Haar カスケード）
+# ==============================
+FACE_CASCADE_FILE = "haarcascade_frontalface_default.xml"
+FACE_DETECT_WIDTH = 320   # 検出はこの幅まで縮小したグレースケール画像で行う
+
+_face_cascade = None
+_face_cascade_lock = threading.Lock()
+
+
+def detect_faces(img_bgr):
+    """顔の矩形 [(x, y, w, h), ...]（元画像の座標・面積の大きい順）"""
+    global _face_cascade
+    h, w = img_bgr.shape[:2]
+    scale = min(1.0, FACE_DETECT_WIDTH / w)
+    small = cv2.resize(img_bgr, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    # CascadeClassifier はプロセスで 1 つだけ読み込み、検出も排他で行う（スレッド安全ではないため）
+    with _face_cascade_lock:
+        if _face_cascade is None:
+            _face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + FACE_CASCADE_FILE)
+        found = _face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(24, 24))
+
+    boxes = [
+        (int(x / scale), int(y / scale), int(bw / scale), int(bh / scale))
+        for x, y, bw, bh in found
+    ]
+    return sorted(boxes, key=lambda b: b[2] * b[3], reverse=True)
+
+
+# ==============================
+# ⏱️ 処理段階ごとの計測
+# ==============================
+class StageTimings:
+    """analyze_image_for_color の段階ごとの経過時間・画素数・確保したバイト数
+
+    timings=StageTimings() を渡したときだけ記録する（渡さなければ計測コストはかからない）。
+    mark() は前回の mark() からの経過時間をその段階の時間として記録する。
+    trace_memory=True のときだけ tracemalloc で各段階の確保量のピーク（段階の開始時点からの増分）を
+    "bytes" に記録する（numpy 配列の確保は追跡されるが、OpenCV 内部の一時バッファは含まない）。
+    tracemalloc は処理を遅くするので、時間を測る実行とは分けて使う。False なら "bytes" は None。
+    """
+
+    def __init__(self, trace_memory=False):
+        self.stages = []          # [{"stage", "seconds", "pixels", "bytes"}, ...]
+        self.pixels = 0           # 分析した画素数（縮小・顔切り出し後）
+        self.skin_pixels = None   # 肌と判定された画素数（分かる経路のみ）
+        self.trace_memory = trace_memory
+        self._started_tracing = False
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._traced = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._last = time.perf_counter()
+
+    def mark(self, stage, pixels=None):
+        now = time.perf_counter()
+        nbytes = None
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            nbytes = max(0, peak - self._traced)
+            self._traced = current
+            tracemalloc.reset_peak()
+        self.stages.append({"stage": stage, "seconds": now - self._last, "pixels": pixels, "bytes": nbytes})
+        self._last = time.perf_counter()
+
+    def stop(self):
+        """trace_memory で始めた tracemalloc を止める（ほかで始めた追跡はそのまま）"""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @property
+    def total_seconds(self):
+        return sum(st["seconds"] for st in self.stages)
+
+    @property
+    def skin_coverage(self):
+        if self.skin_pixels is None or not self.pixels:
+            return None
+        return self.skin_pixels / self.pixels
+
+    def report(self):
+        """段階ごとの内訳を表形式の文字列で返す"""
+        lines = [f"{'stage':<16}{'ms':>10}{'pixels':>12}{'MB':>10}"]
+        for st in self.stages:
+            pixels = "" if st["pixels"] is None else f"{st['pixels']:,}"
+            mb = "" if st["bytes"] is None else f"{st['bytes'] / 1e6:.2f}"
+            lines.append(f"{st['stage']:<16}{st['seconds'] * 1000:>10.2f}{pixels:>12}{mb:>10}")
+        lines.append(f"{'total':<16}{self.total_seconds * 1000:>10.2f}")
+        if self.skin_coverage is not None:
+            lines.append(f"skin coverage: {self.skin_coverage:.1%}")
+        return "\n".join(lines)
+
+
+# ==============================
+# 📐 解像度の上限
+# ==============================
+# 等倍と判定が変わらない範囲で処理時間を頭打ちにする推奨値
+RECOMMENDED_MAX_PIXELS = 1_000_000
+
+
+def limit_resolution(img_bgr, max_pixels):
+    """画素数が max_pixels を超える場合だけ INTER_AREA で縮小 → (画像, 倍率)
+
+    INTER_AREA は画素の面積平均なので、画像全体の平均 BGR は縮小前後でほぼ変わらない。
+    """
+    h, w = img_bgr.shape[:2]
+    if not max_pixels or h * w <= max_pixels:
+        return img_bgr, 1.0
+    scale = (max_pixels / (h * w)) ** 0.5
+    size = (max(1, int(w * scale)), max(1, int(h * scale)))
+    return cv2.resize(img_bgr, size, interpolation=cv2.INTER_AREA), scale
+
+
+# ==============================
+# 🔎 画質チェック（縮小コピーで 1ms 未満）
+# ==============================
+QUALITY_CHECK_SIZE = 256        # 長辺をこの画素数まで縮小して測る
+QUALITY_MIN_BRIGHTNESS = 70     # 輝度の平均（0〜255）がこれ未満なら暗すぎる
+QUALITY_MAX_CLIPPED = 0.6       # 白飛び（輝度 250 以上）の割合の上限
+QUALITY_MIN_SHARPNESS = 100.0   # ラプラシアンの分散の下限（これ未満はピンぼけ・手ぶれ）
+QUALITY_MIN_SKIN = 0.02         # 肌の割合の下限
+
+
+class ImageQuality:
+    """画質チェックの測定値と問題点（issues: [(コード, 理由), ...]、空なら問題なし）
+
+    シャープさのしきい値は、同梱写真から顔まわりだけを切り出した 23 枚（顔が検出できたもの）で決めている。
+    原寸（375〜2500）と、640px に縮小して σ=1 でぼかした Web カメラ相当（208 以上）は通り、
+    σ=3 のぼかし（大半が 60 前後、最大 198）と σ=5（最大 45）は大半が弾かれる。
+    （同梱写真はそのままだと色見本の縁でシャープさが高く出るので、較正には使わない）
+    明るさ・白飛び・肌の割合は、暗く（×0.25）・白飛び・グレースケールに加工した版が弾かれるように決めている。
+    """
+
+    def __init__(self, brightness, clipped, sharpness, skin_coverage):
+        self.brightness = brightness
+        self.clipped = clipped
+        self.sharpness = sharpness
+        self.skin_coverage = skin_coverage
+        self.issues = []
+        if brightness < QUALITY_MIN_BRIGHTNESS:
+            self.issues.append(("dark", "写真が暗すぎます。明るい場所で撮り直してください。"))
+        if clipped > QUALITY_MAX_CLIPPED:
+            self.issues.append(("overexposed", "白飛びしています。強い光や逆光を避けて撮り直してください。"))
+        if sharpness < QUALITY_MIN_SHARPNESS:
+            self.issues.append(("blurry", "写真がぼやけています。ピントを合わせ、手ぶれしないように撮り直してください。"))
+        if skin_coverage < QUALITY_MIN_SKIN:
+            self.issues.append(("no_skin", "肌がほとんど写っていません。顔が大きく写るように撮り直してください。"))
+
+    @property
+    def ok(self):
+        return not self.issues
+
+
+class ImageQualityError(ValueError):
+    """画質チェックで弾いた画像（quality に ImageQuality）"""
+
+    def __init__(self, quality):
+        super().__init__(" ".join(reason for _, reason in quality.issues))
+        self.quality = quality
+
+
+def check_image_quality(img_bgr, skin_backend="ycrcb"):
+    """長辺 QUALITY_CHECK_SIZE の縮小コピーで明るさ・白飛び・シャープさ・肌の割合を測る → ImageQuality
+
+    縮小は INTER_LINEAR（INTER_AREA より 1 桁速い）。ぼけた画像は縮小しても高周波が出ないので、
+    ラプラシアンの分散によるピンぼけ判定にはむしろ差がつきやすい。
+    """
+    h, w = img_bgr.shape[:2]
+    scale = QUALITY_CHECK_SIZE / max(h, w)
+    if scale < 1:
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        img_bgr = cv2.resize(img_bgr, size, interpolation=cv2.INTER_LINEAR)
+
+    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    n = gray.size
+    brightness = float(hist @ np.arange(256)) / n
+    clipped = float(hist[250:].sum()) / n
+    sharpness = float(cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_32F))[1][0, 0] ** 2)
+    skin_coverage = cv2.countNonZero(get_skin_backend(skin_backend).mask(img_bgr)) / n
+    return ImageQuality(brightness, clipped, sharpness, skin_coverage)
+
+
+def analyze_image_for_color(img_bgr, lab_engine="lut", mode="pixels",
+                            hist_bins=DEFAULT_HIST_BINS, max_pixels=None,
+                            memory_budget=None, workers=None, face_roi=False,
+                            skin_backend="ycrcb", season_model=None, quality_gate=False,
+                            info=None, timings=None):
+    """肌色抽出→LAB平均→4シーズン距離→季節とLAB返却
+
+    lab_engine: "lut"（既定・ルックアップテーブル）/ "skimage"（従来の rgb2lab）
+    mode      : "pixels"（画素ごとに変換）/ "histogram"（占有ビンだけ変換）
+                / "progressive"（ランダムに抜き出した画素で判定が固まったら打ち切る・LUT 使用）
+    hist_bins : histogram モードの 1 チャンネルあたりのビン数
+                各ビンの中心の色で LAB に変換するので、画素モードとは量子化の分だけずれる
+                精度の目安（同梱のモデル写真 28 枚、画素モードとの LAB 平均の差）:
+                  16 ビン  → ΔE76 ≤ 0.66、判定シーズンは 4 枚で入れ替わる
+                  32 ビン（既定）→ ΔE76 ≤ 0.35（平均 0.14）、境界付近の 1 枚で入れ替わる
+                  64 ビン  → ΔE76 ≤ 0.18、判定シーズンは全件一致
+                ビンの中心は端から半ビン内側にあるため、真っ黒な画像でも L が 0 にならない
+                （32 ビンで L≈0.96）。判定が境界付近なら画素モードか 64 ビン以上を使う
+    max_pixels: 指定するとマスク処理の前にこの画素数まで縮小する（None で等倍）
+                精度の目安（同梱のモデル写真 28 枚、原寸 2.8MP と 12MP 拡大版で計測）:
+                  1MP 上限   → 等倍との LAB 平均の差 ΔE76 ≤ 0.25、判定シーズンは全件一致
+                  0.25MP 上限 → ΔE76 ≤ 0.6、境界付近の 3 枚で判定が入れ替わる
+                迷ったら RECOMMENDED_MAX_PIXELS（1MP）を使う
+    memory_budget: LUT エンジンで画像を横帯に分け、スレッドで並列処理する（バイト数）
+                中間バッファの合計がおよそこの値に収まるよう帯の高さを決める。
+                各帯の肌画素数と LAB 合計（整数）を足し合わせるので、結果は分割なしと完全に一致
+    workers   : 帯を処理するスレッド数（None で CPU 数）
+    face_roi  : True で一番大きい顔の矩形の中だけを分析する（背景や腕の混入を防ぐ）
+                顔が見つからなければ画像全体で分析する
+    skin_backend: 肌領域抽出のバックエンド名（SKIN_BACKENDS のキー）または SkinSegmenter
+    season_model: 判定に使う SeasonModel（None で現在の SEASONS）
+    quality_gate: True で LAB 変換の前に check_image_quality を行い、問題があれば ImageQualityError
+    info      : dict を渡すと補足情報を書き込む
+                "effective_size"（実際に処理した (幅, 高さ)）, "scale"（縮小倍率）,
+                histogram モードでは "histogram"、帯分割時は "tiles"（帯の数）、
+                progressive モードでは "pixels_used"（LAB を求めた画素数）と "early_exit"、
+                face_roi では "face_box"（(x, y, w, h)、見つからなければ None）、
+                quality_gate では "quality"（ImageQuality）
+    timings   : StageTimings を渡すと段階ごとの時間・画素数（trace_memory なら確保バイト数も）を記録する
+    """
+
+    if timings is not None:
+        timings.mark("start")
+
+    img_bgr, scale = limit_resolution(img_bgr, max_pixels)
+    if info is not None:
+        info["effective_size"] = (img_bgr.shape[1], img_bgr.shape[0])
+        info["scale"] = scale
+    if timings is not None and scale != 1.0:
+        timings.mark("resize", img_bgr.shape[0] * img_bgr.shape[1])
+
+    if quality_gate:
+        quality = check_image_quality(img_bgr, skin_backend)
+        if info is not None:
+            info["quality"] = quality
+        if timings is not None:
+            timings.mark("quality_check")
+        if not quality.ok:
+            raise ImageQualityError(quality)
+
+    if face_roi:
+        faces = detect_faces(img_bgr)
+        if faces:
+            x, y, w, h = faces[0]
+            img_bgr = img_bgr[y:y + h, x:x + w]
+        if info is not None:
+            info["face_box"] = faces[0] if faces else None
+        if timings is not None:
+            timings.mark("face_detect")
+
+    n_pixels = img_bgr.shape[0] * img_bgr.shape[1]
+    if timings is not None:
+        timings.pixels = n_pixels
+    backend = get_skin_backend(skin_backend)
+
+    if mode == "histogram":
+        # ==============================
+        # 🟢 ①② 肌色ヒストグラム → 占有ビンの LAB を重み付き平均
+        # ==============================
+        hist = skin_histogram(img_bgr, hist_bins, backend)
+        if timings is not None:
+            timings.mark("histogram", n_pixels)
+        mean_lab = hist.mean()
+        if info is not None:
+            info["histogram"] = hist
+
+    elif mode == "progressive":
+        # ==============================
+        # 🟠 ①② 抜き取り画素で判定が固まるまで少しずつ LAB 平均を更新
+        # ==============================
+        mean_lab, pixels_used = _progressive_mean_lab(img_bgr, backend, season_model)
+        if timings is not None:
+            timings.mark("sampling", pixels_used)
+        early_exit = mean_lab is not None
+        if not early_exit:
+            # 判定が際どい画像 → 全画素で評価し直す
+            mean_lab = SkinLabSums.from_entries(_lookup_skin_entries(get_lab_lut(), img_bgr, backend)).mean_lab()
+            pixels_used += n_pixels
+            if timings is not None:
+                timings.mark("full_fallback", n_pixels)
+        if info is not None:
+            info["pixels_used"] = pixels_used
+            info["early_exit"] = early_exit
+
+    elif mode != "pixels":
+        raise ValueError(f"未対応の mode です: {mode}")
+
+    elif lab_engine == "lut":
+        # ==============================
+        # 🟡🔵 ①② 肌判定と LAB をテーブル 1 回の参照で取得
+        # ==============================
+        lut = get_lab_lut()
+        if timings is not None:
+            timings.mark("lut_init")
+        if memory_budget:
+            sums, n_tiles = _tiled_lut_sums(img_bgr, memory_budget, workers, backend)
+            if info is not None:
+                info["tiles"] = n_tiles
+            if timings is not None:
+                timings.mark("tiled_lut", n_pixels)
+        else:
+            entries = _lookup_skin_entries(lut, img_bgr, backend)
+            if timings is not None:
+                timings.mark("lut_lookup", n_pixels)
+            sums = SkinLabSums.from_entries(entries)
+            if timings is not None:
+                timings.mark("skin_sums", n_pixels)
+
+        mean_lab = sums.mean_lab()
+        if timings is not None:
+            timings.skin_pixels = sums.skin_count
+
+    elif lab_engine == "skimage":
+        # ==============================
+        # 🟡 ① 肌色領域の抽出（YCrCbマスク）
+        # ==============================
+        if _uses_lut_skin_flag(backend):
+            img_ycrcb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2YCrCb)
+            if timings is not None:
+                timings.mark("cvtColor", n_pixels)
+            mask = cv2.inRange(img_ycrcb, SKIN_YCRCB_LOWER, SKIN_YCRCB_UPPER)
+            if timings is not None:
+                timings.mark("inRange", n_pixels)
+        else:
+            mask = backend.mask(img_bgr)
+            if timings is not None:
+                timings.mark("skin_mask", n_pixels)
+
+        skin_pixels = img_bgr[mask > 0]
+        if timings is not None:
+            timings.skin_pixels = len(skin_pixels)
+            timings.mark("mask_copy", len(skin_pixels))
+
+        if len(skin_pixels) < MIN_SKIN_PIXELS:
+            # 肌が全然取れない場合 → 全体で代用（最低限の処理）
+            skin_pixels = img_bgr.reshape(-1, 3)
+
+        # ==============================
+        # 🔵 ② 肌色を LAB に変換して平均
+        # ==============================
+        from skimage import color
+
+        skin_lab = color.rgb2lab(skin_pixels[:, ::-1] / 255.0)  # BGR→RGB
+        mean_lab = np.mean(skin_lab, axis=0)
+        if timings is not None:
+            timings.mark("rgb2lab", len(skin_pixels))
+
+    else:
+        raise ValueError(f"未対応の lab_engine です: {lab_engine}")
+
+    detected_season, percentages = _score_mean_lab(mean_lab, season_model)
+    if timings is not None:
+        timings.mark("distance")
+    return detected_season, mean_lab, percentages
+
+
+# 帯 1 画素あたりの中間バッファ（BGRA キー 4 + intp インデックス 8 + LUT エントリ 4 + 肌マスク 1）
+TILE_BYTES_PER_PIXEL = 17
+
+
+def _tiled_lut_sums(img_bgr, memory_budget, workers=None, skin_backend="ycrcb"):
+    """横帯ごとの SkinLabSums をスレッドプールで計算して合算 → (合計, 帯の数)
+
+    cvtColor と NumPy の参照・合計は GIL を解放するので、帯ごとに並列に進む。
+    """
+    workers = workers or os.cpu_count() or 1
+    h, w = img_bgr.shape[:2]
+    rows = max(1, int(memory_budget // (workers * w * TILE_BYTES_PER_PIXEL)))
+    bands = [(top, min(top + rows, h)) for top in range(0, h, rows)]
+
+    lut = get_lab_lut()
+    backend = get_skin_backend(skin_backend)
+
+    def band_sums(band):
+        top, bottom = band
+        return SkinLabSums.from_entries(_lookup_skin_entries(lut, img_bgr[top:bottom], backend))
+
+    total = SkinLabSums()
+    with ThreadPoolExecutor(max_workers=min(workers, len(bands))) as pool:
+        for partial in pool.map(band_sums, bands):
+            total = total + partial
+    return total, len(bands)
+
+
+# progressive モードの設定
+PROGRESSIVE_FIRST_CHUNK = 4096      # 最初に抜き取る画素数（以降は倍々に増やす）
+PROGRESSIVE_MAX_FRACTION = 1 / 16   # ここまで抜き取っても決まらなければ全画素で評価
+PROGRESSIVE_MIN_SKIN = 1000         # 判定に使う肌サンプルの最小数
+PROGRESSIVE_Z = 4.0                 # 平均 LAB の誤差を何σまで見込むか
+
+
+def _decision_is_stable(mean_lab, variance, n, season_model=None):
+    """標本の LAB 平均で判定したシーズンが、これ以上標本を増やしても変わらないとみなせるか
+
+    variance は標本の LAB 各チャンネルの分散の和、n は標本数。
+    シーズン距離（パレット各色との距離の平均）は LAB 平均について 1-リプシッツなので、
+    平均の誤差が e なら上位 2 シーズンの差は高々 2e しか動かない。
+    e を PROGRESSIVE_Z × 標準誤差で見積もり、差がその 2 倍を超えたら True。
+    （metric="ciede2000" のモデルでは厳密なリプシッツ性はないので、目安になる）
+    """
+    error = PROGRESSIVE_Z * np.sqrt(variance / n)
+    _, distances = _season_distance_matrix(np.asarray(mean_lab)[np.newaxis, :], season_model)
+    nearest, second = np.sort(distances[0])[:2]
+    return second - nearest > 2 * error
+
+
+def _progressive_mean_lab(img_bgr, skin_backend="ycrcb", season_model=None, seed=0):
+    """画素をランダムに抜き取り、上位 2 シーズンの差が十分に開いたら → (LAB 平均, 使った画素数)
+
+    打ち切りの基準は _decision_is_stable（画素ごとの LAB のばらつきから見積もる）。
+    決まらなければ (None, 使った画素数) を返す。
+    """
+    pixels = np.ascontiguousarray(img_bgr, dtype=np.uint8).reshape(-1, 3)
+    n = len(pixels)
+    limit = int(n * PROGRESSIVE_MAX_FRACTION)
+    lut = get_lab_lut()
+    backend = get_skin_backend(skin_backend)
+    rng = np.random.default_rng(seed)
+
+    used = 0
+    skin_count = 0
+    lab_sum = np.zeros(3)
+    lab_sq_sum = np.zeros(3)
+    chunk = PROGRESSIVE_FIRST_CHUNK
+    while used + chunk <= limit:
+        entries = _lookup_skin_entries(lut, pixels[rng.integers(0, n, chunk)], backend)
+        lab = lut.decode(entries[lut.skin_mask(entries)])
+        used += chunk
+        chunk *= 2
+
+        skin_count += len(lab)
+        lab_sum += lab.sum(axis=0)
+        lab_sq_sum += (lab ** 2).sum(axis=0)
+        if skin_count < PROGRESSIVE_MIN_SKIN:
+            continue
+
+        mean_lab = lab_sum / skin_count
+        variance = np.maximum(lab_sq_sum / skin_count - mean_lab ** 2, 0).sum()
+        if _decision_is_stable(mean_lab, variance, skin_count, season_model):
+            return mean_lab, used
+
+    return None, used
+
+
+def _score_mean_lab(mean_lab, season_model=None):
+    """LAB 平均 → (判定シーズン, 適合度％ dict)"""
 
     # ==============================
     # 🔴 ③ 各シーズンとの距離を計算
     # ==============================
-    season_distances = {
-        season: np.mean(np.linalg.norm(mean_lab - palette, axis=1))
-        for season, palette in SEASONS.items()
-    }
+    names, distances = _season_distance_matrix(mean_lab[np.newaxis, :], season_model)
+    season_distances = dict(zip(names, distances[0]))
 
     # 一番距離が近い季節を選ぶ
     detected_season = min(season_distances, key=season_distances.get)
@@ -64,8 +1095,900 @@ def analyze_image_for_color(img_bgr):
     # ==============================
     # 🟣 ④ 適合度（％）に正規化
     # ==============================
-    inv_scores = {k: 1 / (1 + v) for k, v in season_distances.items()}
-    total = sum(inv_scores.values())
-    percentages = {k: round((v / total) * 100, 2) for k, v in inv_scores.items()}
+    percentages = dict(zip(names, SeasonModel.percentages(distances)[0]))
+
+    return detected_season, percentages
+
+
+def analyze_faces_for_color(img_bgr, max_pixels=None, workers=None, season_model=None):
+    """集合写真用：顔ごとに肌色抽出→LAB平均→シーズン判定（顔ごとに並列）
+
+    戻り値: 顔ごとの dict のリスト（面積の大きい順）
+      {"box": (x, y, w, h), "season", "mean_lab", "percentages"}
+    処理するのは各顔の矩形の中だけなので、コストは顔の面積の合計に比例する。
+    """
+    img_bgr, scale = limit_resolution(img_bgr, max_pixels)
+    faces = detect_faces(img_bgr)
+    if not faces:
+        return []
+    lut = get_lab_lut()
+
+    def score_face(box):
+        x, y, w, h = box
+        mean_lab = SkinLabSums.from_entries(lut.lookup(img_bgr[y:y + h, x:x + w])).mean_lab()
+        season, percentages = _score_mean_lab(mean_lab, season_model)
+        # 矩形は入力画像の座標に戻して返す
+        original_box = tuple(int(round(v / scale)) for v in box)
+        return {"box": original_box, "season": season, "mean_lab": mean_lab, "percentages": percentages}
+
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=min(workers, len(faces))) as pool:
+        return list(pool.map(score_face, faces))
+
+
+def _season_distance_matrix(mean_labs, season_model=None):
+    """(N, 3) の LAB 平均 → シーズン名リストと (N, S) の平均距離行列"""
+    model = season_model or default_season_model()
+    return model.names, model.distances(mean_labs)
+
+
+# 複数画像の診断で 1 度にまとめて処理する画素数の上限（1 画素あたり約 20 バイトの中間バッファ）
+BATCH_PIXEL_BUDGET = 4_000_000
+
+
+def _segment_sums(values, sizes):
+    """values を先頭から sizes 個ずつの区間に分けた合計（長さ 0 の区間は 0）"""
+    dtype = np.int64 if np.issubdtype(values.dtype, np.integer) or values.dtype == bool else np.float64
+    out = np.zeros((len(sizes),) + values.shape[1:], dtype=dtype)
+    nonempty = sizes > 0
+    if nonempty.any():
+        starts = (np.cumsum(sizes) - sizes)[nonempty]
+        if values.dtype == bool:
+            values = values.view(np.uint8)
+        out[nonempty] = np.add.reduceat(values, starts, axis=0, dtype=dtype)
+    return out
+
+
+def _batch_mean_labs(images, sizes, lab_engine):
+    """画像の組（合計画素数が BATCH_PIXEL_BUDGET 程度）→ (N, 3) の肌色 LAB 平均"""
+    if len(images) == 1:
+        flat = np.ascontiguousarray(images[0], dtype=np.uint8).reshape(1, -1, 3)
+    else:
+        flat = np.concatenate(
+            [np.asarray(img, dtype=np.uint8).reshape(-1, 3) for img in images]
+        ).reshape(1, -1, 3)
+
+    # ==============================
+    # 🟡 ① 肌色マスク（組ごとに 1 回）
+    # ==============================
+    if lab_engine == "lut":
+        entries = get_lab_lut().lookup(flat)
+        mask = entries >= (1 << 24)
+    elif lab_engine == "skimage":
+        img_ycrcb = cv2.cvtColor(flat, cv2.COLOR_BGR2YCrCb)
+        mask = cv2.inRange(img_ycrcb, SKIN_YCRCB_LOWER, SKIN_YCRCB_UPPER).ravel() > 0
+        del img_ycrcb
+    else:
+        raise ValueError(f"未対応の lab_engine です: {lab_engine}")
+
+    # 肌が取れない画像は全画素で代用（単体版と同じルール）
+    skin_counts = _segment_sums(mask, sizes)
+    fallback = skin_counts < MIN_SKIN_PIXELS
+    counts = np.where(fallback, sizes, skin_counts)
+
+    # ==============================
+    # 🔵 ② LAB 変換と画像ごとの平均（画像の区切りで reduceat）
+    # ==============================
+    if lab_engine == "lut":
+        planes = entries.view(np.uint8).reshape(-1, 4)
+        all_sums = np.stack([_segment_sums(planes[:, c], sizes) for c in range(3)], axis=1)
+        # 肌以外のエントリを 0 にして肌だけの合計を取る
+        np.multiply(entries, mask, out=entries)
+        skin_sums = np.stack([_segment_sums(planes[:, c], sizes) for c in range(3)], axis=1)
+        sums = np.where(fallback[:, np.newaxis], all_sums, skin_sums)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return LabLookupTable.decode_mean(sums, counts)
+
+    from skimage import color
+
+    offsets = np.cumsum(sizes) - sizes
+    for i in np.flatnonzero(fallback):
+        mask[offsets[i]:offsets[i] + sizes[i]] = True
+    skin_lab = color.rgb2lab(flat[0][mask][:, ::-1] / 255.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return _segment_sums(skin_lab, counts) / counts[:, np.newaxis]
+
+
+def analyze_images_for_color(images, lab_engine="lut", season_model=None, pixel_budget=BATCH_PIXEL_BUDGET):
+    """複数画像をまとめて診断（リスト or (N, H, W, 3) 配列）
+
+    画像は合計画素数が pixel_budget を超えない組に分けて処理するので、
+    何千枚渡しても中間バッファは組 1 つ分（1 画素あたり約 20 バイト）で頭打ちになる。
+    （1 枚で pixel_budget を超える画像はその 1 枚だけで 1 組）
+
+    戻り値: (seasons, mean_labs, percentages, season_names)
+      seasons      : (N,) 判定シーズン名
+      mean_labs    : (N, 3) 肌色 LAB 平均
+      percentages  : (N, S) 適合度（列順は season_names）
+    """
+    if not (isinstance(images, np.ndarray) and images.ndim == 4):
+        images = list(images)
+    n = len(images)
+    sizes = np.array([img.shape[0] * img.shape[1] for img in images], dtype=np.int64)
+
+    model = season_model or default_season_model()
+    names = model.names
+    if n == 0:
+        return (np.empty(0, dtype=object), np.empty((0, 3)),
+                np.empty((0, len(names))), names)
+
+    mean_labs = np.empty((n, 3))
+    start = 0
+    while start < n:
+        stop = start + 1
+        total = sizes[start]
+        while stop < n and total + sizes[stop] <= pixel_budget:
+            total += sizes[stop]
+            stop += 1
+        mean_labs[start:stop] = _batch_mean_labs(images[start:stop], sizes[start:stop], lab_engine)
+        start = stop
+
+    # ==============================
+    # 🔴 ③ 距離 → ④ 適合度（ベクトル化）
+    # ==============================
+    best, distances, percentages = model.score(mean_labs)
+    seasons = np.array(names, dtype=object)[best]
+
+    return seasons, mean_labs, percentages, names
+
+
+# ==============================
+# ♻️ 作業バッファを再利用する分析器
+# ==============================
+class Analyzer:
+    """作業バッファを使い回す分析器（長時間動くサーバー向け）
+
+    バッファはこれまでで最大のフレームに合わせて確保し、以降は
+    dst= / out= 指定の OpenCV・NumPy 呼び出しだけで処理する。
+    同程度のサイズの画像が続く限り、ウォームアップ後はフレームサイズの確保が発生しない。
+    切り出し（img[y0:y1, x0:x1]）のように行の中の画素が連続しているビューもコピーせず、
+    BGRA キーへの変換で直接ワークスペースに書き込む。間引き（img[::2, ::2]）や転置のように
+    画素が飛び飛びのビューと uint8 以外の画像は、OpenCV / NumPy がフレームサイズのコピーを作る。
+    ワークスペースは 1 画素あたり 9 バイト（BGRA キー 4 + LUT エントリ 4 + 肌マスク 1）
+    ＋ LUT 参照用のインデックスバッファ（固定 2MB）。
+    スレッド間では共有しないこと（スレッドごとに 1 つ作る）。
+    """
+
+    # np.take はインデックスを intp に変換するため、固定サイズの区間ごとに参照する
+    TAKE_CHUNK = 1 << 18
+
+    def __init__(self, capacity=0, lut=None, season_model=None):
+        self.lut = lut if lut is not None else get_lab_lut()
+        self.season_model = season_model
+        self.capacity = 0
+        self._keys = self._entries = self._skin = None
+        self._index = np.empty(self.TAKE_CHUNK, dtype=np.intp)
+        self._reserve(capacity)
+
+    def _reserve(self, n_pixels):
+        if n_pixels <= self.capacity:
+            return
+        self._keys = np.empty((1, n_pixels, 4), dtype=np.uint8)
+        self._entries = np.empty(n_pixels, dtype=np.uint32)
+        self._skin = np.empty(n_pixels, dtype=bool)
+        self.capacity = n_pixels
+
+    @property
+    def workspace_nbytes(self):
+        if self.capacity == 0:
+            return 0
+        return self._keys.nbytes + self._entries.nbytes + self._skin.nbytes + self._index.nbytes
+
+    def analyze(self, img_bgr):
+        """analyze_image_for_color（LUT エンジン）と同じ結果を返す"""
+        src = np.asarray(img_bgr, dtype=np.uint8)
+        h, w = src.shape[:2]
+        n = h * w
+        self._reserve(n)
+
+        keys_bgra = self._keys[:, :n]
+        keys = keys_bgra.view(np.uint32).reshape(-1)
+        entries = self._entries[:n]
+        skin = self._skin[:n]
+
+        # ① BGR → 24bit キー（アルファを落とす。行の間隔が空いたビューもそのまま読める）
+        cv2.cvtColor(src, cv2.COLOR_BGR2BGRA, dst=keys_bgra.reshape(h, w, 4))
+        np.bitwise_and(keys, 0xFFFFFF, out=keys)
+
+        # ② LUT 参照（mode="clip" は out をバッファリングしない）
+        for start in range(0, n, self.TAKE_CHUNK):
+            stop = min(start + self.TAKE_CHUNK, n)
+            index = self._index[:stop - start]
+            np.copyto(index, keys[start:stop])
+            np.take(self.lut.table, index, out=entries[start:stop], mode="clip")
+        np.greater_equal(entries, 1 << 24, out=skin)
+
+        if np.count_nonzero(skin) >= MIN_SKIN_PIXELS:
+            # 肌以外のエントリを 0 にして合計から外す
+            np.multiply(entries, skin, out=entries)
+            count = np.count_nonzero(skin)
+        else:
+            # 肌が全然取れない場合 → 全体で代用（最低限の処理）
+            count = n
+
+        # ③ 符号化 LAB の各バイトを直接合計（リトルエンディアンの下位 3 バイト）
+        planes = entries.view(np.uint8).reshape(n, 4)
+        sums = [planes[:, c].sum(dtype=np.int64) for c in range(3)]
+        mean_lab = LabLookupTable.decode_mean(sums, count)
+
+        detected_season, percentages = _score_mean_lab(mean_lab, self.season_model)
+        return detected_season, mean_lab, percentages
+
+
+# ==============================
+# 📹 ライブ映像の分析
+# ==============================
+LIVE_MAX_PIXELS = 300_000   # ライブ映像は 1 フレームをこの画素数まで縮小して分析する
+
+
+class LiveAnalyzer:
+    """カメラなどのフレーム列を一定のフレームレート以内で分析し、結果をなめらかにする
+
+    - target_fps を超える頻度では分析せず、処理が追いつかないフレームは読み捨てる
+    - 顔検出は redetect_every フレームに 1 回だけ行い（顔がなければ次の検出まで全体を分析）、
+      その間は前回の顔の矩形と（LUT の肌フラグを使えないバックエンドでは）肌マスクを使い回す
+    - LAB 平均は指数移動平均（ema_alpha）でならし、判定シーズンは新しいシーズンが
+      season_hold 回続けて 1 位になったときだけ切り替える
+    """
+
+    def __init__(self, target_fps=10.0, ema_alpha=0.25, redetect_every=15, season_hold=3,
+                 max_pixels=LIVE_MAX_PIXELS, skin_backend="ycrcb", season_model=None):
+        self.target_fps = target_fps
+        self.ema_alpha = ema_alpha
+        self.redetect_every = redetect_every
+        self.season_hold = season_hold
+        self.max_pixels = max_pixels
+        self.backend = get_skin_backend(skin_backend)
+        self.season_model = season_model
+        self.lut = get_lab_lut()
+        self.reset()
+
+    def reset(self):
+        self.mean_lab = None
+        self.season = None
+        self.face_box = None
+        self._mask = None
+        self._candidate = None
+        self._candidate_count = 0
+        self._since_detect = None
+        self.analyzed = 0
+        self.skipped = 0
+
+    def _skin_entries(self, roi):
+        """ROI の LUT エントリ（肌フラグは使い回しのマスクで差し替える）"""
+        if _uses_lut_skin_flag(self.backend):
+            return self.lut.lookup(roi)
+        if self._mask is None or self._mask.shape != roi.shape[:2]:
+            self._mask = self.backend.mask(roi)
+        entries = self.lut.lookup(roi)
+        np.bitwise_and(entries, 0xFFFFFF, out=entries)
+        entries |= (self._mask.ravel() > 0).astype(np.uint32) << 24
+        return entries
 
+    def update(self, frame_bgr):
+        """1 フレームを分析して状態を更新 → 結果の dict
+
+        {"season", "mean_lab"（ならした値）, "frame_mean_lab"（このフレームだけの値・肌が
+        足りなければ None）, "percentages", "face_box"（縮小後の座標）, "analyzed", "skipped"}
+        """
+        frame_bgr, _ = limit_resolution(frame_bgr, self.max_pixels)
+
+        if self._since_detect is None or self._since_detect >= self.redetect_every:
+            faces = detect_faces(frame_bgr)
+            self.face_box = faces[0] if faces else None
+            self._mask = None
+            self._since_detect = 0
+        self._since_detect += 1
+
+        roi = frame_bgr
+        if self.face_box is not None:
+            x, y, w, h = self.face_box
+            roi = frame_bgr[y:y + h, x:x + w]
+        sums = SkinLabSums.from_entries(self._skin_entries(roi))
+        self.analyzed += 1
+
+        frame_mean_lab = None
+        if sums.skin_count >= MIN_SKIN_PIXELS or self.mean_lab is None:
+            frame_mean_lab = sums.mean_lab()
+            if self.mean_lab is None:
+                self.mean_lab = frame_mean_lab
+            else:
+                self.mean_lab = self.ema_alpha * frame_mean_lab + (1 - self.ema_alpha) * self.mean_lab
+
+        best, percentages = _score_mean_lab(self.mean_lab, self.season_model)
+        if self.season is None or best == self.season:
+            self.season = best
+            self._candidate, self._candidate_count = None, 0
+        elif best == self._candidate:
+            self._candidate_count += 1
+            if self._candidate_count >= self.season_hold:
+                self.season = best
+                self._candidate, self._candidate_count = None, 0
+        else:
+            self._candidate, self._candidate_count = best, 1
+
+        return {
+            "season": self.season,
+            "mean_lab": self.mean_lab,
+            "frame_mean_lab": frame_mean_lab,
+            "percentages": percentages,
+            "face_box": self.face_box,
+            "analyzed": self.analyzed,
+            "skipped": self.skipped,
+        }
+
+    def run(self, frames, source_fps=None):
+        """フレームのイテラブルを分析し、分析したフレームごとに update() の結果を yield する
+
+        source_fps を渡すと（動画ファイルなど）フレーム番号 / source_fps を時刻とみなし、
+        実際の処理時間ぶんのフレームも読み捨てる。None（カメラ）なら経過時間で判断する。
+        経過時間はフレームを受け取った時刻なので、カメラは camera_frames のように
+        分析中にたまった古いフレームを捨てて最新の 1 枚を渡すこと。
+        """
+        interval = 1.0 / self.target_fps if self.target_fps else 0.0
+        start = time.perf_counter()
+        next_due = 0.0
+        busy_until = 0.0
+        for i, frame in enumerate(frames):
+            now = i / source_fps if source_fps else time.perf_counter() - start
+            if now < next_due or now < busy_until:
+                self.skipped += 1
+                continue
+            began = time.perf_counter()
+            result = self.update(frame)
+            elapsed = time.perf_counter() - began
+            next_due = now + interval
+            busy_until = now + elapsed
+            yield result
+
+
+def camera_frames(source=0):
+    """cv2.VideoCapture（カメラ番号または動画ファイル）のフレームを返すジェネレーター
+
+    動画ファイルは全フレームを順に返す（間引きは LiveAnalyzer.run の source_fps で行う）。
+    カメラは読み取り用のスレッドが最新の 1 枚だけを持ち、分析している間に届いたフレームは捨てる。
+    ドライバーのバッファにたまったフレームを後から順に読むと、分析が実時間から遅れ続けるため。
+    """
+    capture = cv2.VideoCapture(source)
+    if not isinstance(source, int):
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield frame
+        finally:
+            capture.release()
+        return
+
+    capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)   # 対応していないバックエンドでは無視される
+    ready = threading.Condition()
+    latest = {"frame": None, "seq": 0, "stop": False}
+
+    def read_frames():
+        while True:
+            ok, frame = capture.read()
+            with ready:
+                if not ok or latest["stop"]:
+                    latest["stop"] = True
+                    ready.notify()
+                    return
+                latest["frame"] = frame
+                latest["seq"] += 1
+                ready.notify()
+
+    reader = threading.Thread(target=read_frames, name="camera-frames", daemon=True)
+    reader.start()
+    seen = 0
+    try:
+        while True:
+            with ready:
+                ready.wait_for(lambda: latest["seq"] != seen or latest["stop"])
+                if latest["seq"] == seen:
+                    break
+                frame, seen = latest["frame"], latest["seq"]
+            yield frame
+    finally:
+        with ready:
+            latest["stop"] = True
+        reader.join()
+        capture.release()
+
+
+# ==============================
+# 🎞️ 動画ファイルの分析
+# ==============================
+VIDEO_MIN_FRAMES = 3    # 打ち切りを判断する前に必ず読むフレーム数
+VIDEO_MAX_FRAMES = 24   # 決まらなくてもここで打ち切る
+VIDEO_STRIDE_SECONDS = 1.0   # フレーム数が分からない動画で、先頭から読むときの間隔（秒）
+
+
+def _video_sample_positions(frame_count):
+    """動画全体に散らばるフレーム番号を粗い順に返す（1/2, 1/4, 3/4, 1/8, ... の位置）"""
+    seen = set()
+    denominator = 2
+    while len(seen) < frame_count:
+        for numerator in range(1, denominator, 2):
+            index = numerator * frame_count // denominator
+            if index not in seen:
+                seen.add(index)
+                yield index
+        denominator *= 2
+        if denominator > 2 * frame_count:
+            break
+
+
+def _video_frames(capture, frame_count):
+    """動画から分析するフレームを (フレーム番号, フレーム) で返す
+
+    フレーム数が分かれば _video_sample_positions の位置へシークして読む。
+    ブラウザで録画した WebM などフレーム数が 0 以下のときはシークできる位置が分からないので、
+    先頭から順に読み、VIDEO_STRIDE_SECONDS ごとに 1 枚だけ取り出す（間のフレームは grab で読み飛ばす）。
+    """
+    if frame_count > 0:
+        for index in _video_sample_positions(frame_count):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            ok, frame = capture.read()
+            if ok:
+                yield index, frame
+        return
+
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    stride = max(1, round((fps if 0 < fps < 1000 else 30.0) * VIDEO_STRIDE_SECONDS))
+    index = 0
+    while True:
+        if index % stride == 0:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield index, frame
+        elif not capture.grab():
+            return
+        index += 1
+
+
+def analyze_video_for_color(path, max_pixels=LIVE_MAX_PIXELS, face_roi=False, skin_backend="ycrcb",
+                            season_model=None, min_frames=VIDEO_MIN_FRAMES, max_frames=VIDEO_MAX_FRAMES,
+                            info=None):
+    """動画ファイル → analyze_image_for_color と同じ (季節, LAB 平均, 適合度％ dict)
+
+    全フレームはデコードせず、CAP_PROP_POS_FRAMES でのシークで動画全体に散らばるフレームだけを読む
+    （シークのコストは直前のキーフレームからのデコード分。フレーム数が分からない動画は
+    先頭から一定間隔で読む → _video_frames）。各フレームの肌画素数と LAB 合計
+    （SkinLabSums）を足し合わせ、フレームごとの LAB 平均のばらつきから求めた標準誤差に対して
+    上位 2 シーズンの差が十分に開いたら（_decision_is_stable）読むのをやめる。
+    info には "frame_count"（動画のフレーム数。分からなければ 0 以下）, "frames_decoded", "frame_indices", "converged" を書き込む。
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"動画を開けません: {path}")
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    backend = get_skin_backend(skin_backend)
+    lut = get_lab_lut()
+
+    total = SkinLabSums()
+    frame_means = []
+    frame_indices = []
+    converged = False
+    try:
+        for index, frame in _video_frames(capture, frame_count):
+            frame_indices.append(index)
+
+            frame, _ = limit_resolution(frame, max_pixels)
+            if face_roi:
+                faces = detect_faces(frame)
+                if faces:
+                    x, y, w, h = faces[0]
+                    frame = frame[y:y + h, x:x + w]
+            sums = SkinLabSums.from_entries(_lookup_skin_entries(lut, frame, backend))
+            total = total + sums
+            if sums.skin_count >= MIN_SKIN_PIXELS:
+                frame_means.append(sums.mean_lab())
+
+            if len(frame_means) >= max(min_frames, 2):
+                variance = np.var(frame_means, axis=0, ddof=1).sum()
+                if _decision_is_stable(total.mean_lab(), variance, len(frame_means), season_model):
+                    converged = True
+                    break
+            if len(frame_indices) >= max_frames:
+                break
+    finally:
+        capture.release()
+
+    if info is not None:
+        info["frame_count"] = frame_count
+        info["frames_decoded"] = len(frame_indices)
+        info["frame_indices"] = frame_indices
+        info["converged"] = converged
+    if not frame_indices:
+        raise ValueError(f"動画からフレームを読み込めません: {path}")
+
+    mean_lab = total.mean_lab()
+    detected_season, percentages = _score_mean_lab(mean_lab, season_model)
     return detected_season, mean_lab, percentages
+
+
+# ==============================
+# 🧭 顔まわりの領域ごとの LAB（頬・額・髪・目元）
+# ==============================
+# 顔の矩形 (x, y, w, h) に対する相対座標 (x0, y0, x1, y1) の矩形リスト
+FACE_REGIONS = {
+    "forehead": [(0.30, 0.08, 0.70, 0.22)],
+    "cheeks": [(0.15, 0.55, 0.35, 0.75), (0.65, 0.55, 0.85, 0.75)],
+    "eyes": [(0.20, 0.36, 0.80, 0.48)],
+    "hair": [(0.20, -0.22, 0.80, -0.04)],
+}
+
+# 肌（頬）と髪の明度差によるコントラスト区分
+CONTRAST_LEVELS = [(20.0, "low"), (40.0, "medium"), (float("inf"), "high")]
+
+
+def analyze_face_regions(img_bgr, face_box=None, regions=FACE_REGIONS):
+    """顔まわりの各領域の LAB 平均とコントラストを 1 回の変換で求める
+
+    顔の周辺だけを LUT で 8bit LAB に変換し、その積分画像（summed-area table）から
+    各矩形の合計を 4 点の参照で取り出す。領域を増やしてもほぼコストは増えない。
+    戻り値: {"face_box", "regions": {名前: LAB 平均}, "contrast", "contrast_level"}
+            （顔が見つからなければ None）
+    """
+    if face_box is None:
+        faces = detect_faces(img_bgr)
+        if not faces:
+            return None
+        face_box = faces[0]
+    x, y, w, h = face_box
+    img_h, img_w = img_bgr.shape[:2]
+
+    # --- 全領域を囲む範囲（画像内に収める） ---
+    rects = {
+        name: [
+            (int(x + fx0 * w), int(y + fy0 * h), int(x + fx1 * w), int(y + fy1 * h))
+            for fx0, fy0, fx1, fy1 in boxes
+        ]
+        for name, boxes in regions.items()
+    }
+    all_rects = [r for boxes in rects.values() for r in boxes]
+    left = max(0, min(r[0] for r in all_rects))
+    top = max(0, min(r[1] for r in all_rects))
+    right = min(img_w, max(r[2] for r in all_rects))
+    bottom = min(img_h, max(r[3] for r in all_rects))
+
+    # --- 1 回だけ LAB に変換して積分画像を作る ---
+    area = img_bgr[top:bottom, left:right]
+    entries = get_lab_lut().lookup(area)
+    encoded = np.ascontiguousarray(entries.view(np.uint8).reshape(area.shape[0], area.shape[1], 4)[:, :, :3])
+    sat = cv2.integral(encoded, sdepth=cv2.CV_64F)
+
+    region_labs = {}
+    for name, boxes in rects.items():
+        sums = np.zeros(3)
+        count = 0
+        for x0, y0, x1, y1 in boxes:
+            # 範囲外は切り詰め、積分画像の座標に直す
+            x0, x1 = np.clip([x0 - left, x1 - left], 0, right - left)
+            y0, y1 = np.clip([y0 - top, y1 - top], 0, bottom - top)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            sums += sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+            count += (x1 - x0) * (y1 - y0)
+        region_labs[name] = LabLookupTable.decode_mean(sums, count) if count else None
+
+    # --- コントラスト（頬と髪の明度差） ---
+    contrast = None
+    contrast_level = None
+    if region_labs.get("cheeks") is not None and region_labs.get("hair") is not None:
+        contrast = float(abs(region_labs["cheeks"][0] - region_labs["hair"][0]))
+        contrast_level = next(label for limit, label in CONTRAST_LEVELS if contrast < limit)
+
+    return {
+        "face_box": face_box,
+        "regions": region_labs,
+        "contrast": contrast,
+        "contrast_level": contrast_level,
+    }
+
+
+# ==============================
+# 🎨 主要色の抽出（ミニバッチ k-means, LAB）
+# ==============================
+DOMINANT_SAMPLE_SIZE = 20_000   # k-means に使う画素数の上限（画像の大きさによらず一定のコスト）
+DOMINANT_BATCH_SIZE = 1024
+DOMINANT_TOL = 0.5              # 代表色の移動量（ΔE76）がこれ未満の反復が続いたら収束
+DOMINANT_PATIENCE = 3
+
+
+def _kmeans_plus_plus(samples, k, rng):
+    """k-means++ の初期値（距離の 2 乗に比例した確率で次の中心を選ぶ）"""
+    centers = np.empty((k, 3), dtype=np.float32)
+    centers[0] = samples[rng.integers(len(samples))]
+    diff = samples - centers[0]
+    d2 = np.einsum("ij,ij->i", diff, diff)
+    for i in range(1, k):
+        cumulative = np.cumsum(d2, dtype=np.float64)
+        if cumulative[-1] > 0:
+            idx = min(int(np.searchsorted(cumulative, rng.random() * cumulative[-1], side="right")), len(samples) - 1)
+        else:
+            idx = rng.integers(len(samples))
+        centers[i] = samples[idx]
+        diff = samples - centers[i]
+        np.minimum(d2, np.einsum("ij,ij->i", diff, diff), out=d2)
+    return centers
+
+
+def _nearest_center(points, centers):
+    # |p - c|² = |p|² - 2 p·c + |c|²（|p|² は argmin に影響しない）
+    return np.argmin((centers ** 2).sum(axis=1) - 2 * points @ centers.T, axis=1)
+
+
+def dominant_colors(img_bgr, k=5, exclude_skin=True, time_budget=0.05, max_iter=100,
+                    sample_size=DOMINANT_SAMPLE_SIZE, batch_size=DOMINANT_BATCH_SIZE, seed=0):
+    """画像の主要色（髪・服・背景など）→ [{"lab", "hex", "weight"}, ...]（割合の大きい順・最大 k 件）
+
+    画素を最大 sample_size 個ランダムに抜き出して LUT で LAB にし、ミニバッチ k-means
+    （Sculley 2010。中心はそのクラスタに入った点の累積平均で更新）でまとめる。
+    k-means++ で（先頭 3 バッチ分の画素から）初期化し、中心の移動が DOMINANT_TOL 未満の反復が DOMINANT_PATIENCE 回続くか、
+    max_iter 回か、time_budget 秒を超えたら打ち切る。weight は抜き出した画素に占める割合。
+    exclude_skin=True では肌と判定された画素を除く（肌が大半の写真なら全画素を使う）。
+    """
+    deadline = time.perf_counter() + time_budget
+    rng = np.random.default_rng(seed)
+    pixels = np.ascontiguousarray(img_bgr, dtype=np.uint8).reshape(-1, 3)
+    if len(pixels) > sample_size:
+        pixels = pixels[rng.integers(len(pixels), size=sample_size)]
+    entries = get_lab_lut().lookup(pixels)
+    if exclude_skin:
+        non_skin = entries < (1 << 24)
+        if np.count_nonzero(non_skin) >= k:
+            entries = entries[non_skin]
+    samples = LabLookupTable.decode(entries).astype(np.float32)
+    k = min(k, len(samples))
+    if k == 0:
+        return []
+
+    # 初期化は先頭 3 バッチ分だけで行う（samples はすでにランダムな並び）
+    centers = _kmeans_plus_plus(samples[:3 * batch_size], k, rng)
+    counts = np.zeros(k, dtype=np.float64)
+    calm = 0
+    for _ in range(max_iter):
+        batch = samples[rng.integers(len(samples), size=min(batch_size, len(samples)))]
+        labels = _nearest_center(batch, centers)
+        n = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=batch[:, c], minlength=k) for c in range(3)], axis=1)
+        counts += n
+        hit = n > 0
+        new_centers = centers.copy()
+        new_centers[hit] += ((sums[hit] - n[hit, np.newaxis] * centers[hit]) / counts[hit, np.newaxis]).astype(np.float32)
+        shift = float(np.sqrt(((new_centers - centers) ** 2).sum(axis=1)).max())
+        centers = new_centers
+        calm = calm + 1 if shift < DOMINANT_TOL else 0
+        if calm >= DOMINANT_PATIENCE or time.perf_counter() > deadline:
+            break
+
+    weights = np.bincount(_nearest_center(samples, centers), minlength=k) / len(samples)
+    order = np.argsort(-weights, kind="stable")
+    order = order[weights[order] > 0]   # 同じ色に重なった中心は除く
+    from skimage import color
+
+    rgb = color.lab2rgb(centers[order].astype(np.float64)[np.newaxis])[0]
+    hexes = ["#%02X%02X%02X" % tuple(c) for c in np.clip(np.rint(rgb * 255), 0, 255).astype(int)]
+    return [
+        {"lab": centers[i].astype(np.float64), "hex": h, "weight": float(weights[i])}
+        for i, h in zip(order, hexes)
+    ]
+
+
+# ==============================
+# 🧣 ドレープ（布当て）プレビュー
+# ==============================
+DRAPE_TILE_WIDTH = 240      # コンタクトシート 1 コマの幅
+DRAPE_STRENGTH = 0.6        # 顔以外の部分をどれだけパレット色に寄せるか（0〜1）
+
+
+def draping_face_mask(img_bgr):
+    """ドレープで色を付けない部分（顔と髪）の 0/255 マスク
+
+    一番大きい顔の矩形を上下に広げた楕円。顔が見つからなければ肌マスクを広げたもの。
+    """
+    h, w = img_bgr.shape[:2]
+    mask = np.zeros((h, w), dtype=np.uint8)
+    faces = detect_faces(img_bgr)
+    if faces:
+        x, y, bw, bh = faces[0]
+        center = (x + bw // 2, y + bh // 2 - bh // 10)
+        cv2.ellipse(mask, center, (int(bw * 0.7), int(bh * 0.85)), 0, 0, 360, 255, -1)
+    else:
+        skin = get_skin_backend("ycrcb").mask(img_bgr)
+        mask = cv2.dilate(skin, np.ones((15, 15), dtype=np.uint8))
+    return mask
+
+
+def draping_contact_sheet(img_bgr, colors_bgr, face_mask=None, tile_width=DRAPE_TILE_WIDTH,
+                          strength=DRAPE_STRENGTH, columns=4):
+    """顔以外をパレットの各色に寄せた画像を並べたコンタクトシート（BGR uint8）
+
+    縮小した画像 1 枚とぼかしたマスク 1 枚から、N 色ぶんのコマを 1 回のブロードキャスト
+    (1, h, w, 3) × (N, 1, 1, 3) で合成する（色ごとに OpenCV を呼ばない）。
+    コマは colors_bgr の順に左上から columns 列で並ぶ。
+    """
+    colors = np.asarray(colors_bgr, dtype=np.float32).reshape(-1, 1, 1, 3)
+    if face_mask is None:
+        face_mask = draping_face_mask(img_bgr)
+
+    h, w = img_bgr.shape[:2]
+    scale = min(1.0, tile_width / w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    small = cv2.resize(img_bgr, size, interpolation=cv2.INTER_AREA) if scale < 1 else img_bgr
+    keep = cv2.resize(face_mask, size, interpolation=cv2.INTER_AREA).astype(np.float32) / 255
+    keep = cv2.GaussianBlur(keep, (0, 0), max(1.0, size[0] / 60))   # 境目をなじませる
+
+    weight = (strength * (1 - keep))[np.newaxis, :, :, np.newaxis]
+    tiles = small.astype(np.float32)[np.newaxis] * (1 - weight) + colors * weight
+
+    # --- 余白を付けて rows × columns に並べる ---
+    n = len(tiles)
+    columns = max(1, min(columns, n))
+    rows = -(-n // columns)
+    pad = 4
+    tiles = np.pad(tiles, ((0, rows * columns - n), (pad, pad), (pad, pad), (0, 0)), constant_values=255)
+    th, tw = tiles.shape[1:3]
+    sheet = tiles.reshape(rows, columns, th, tw, 3).transpose(0, 2, 1, 3, 4).reshape(rows * th, columns * tw, 3)
+    return np.clip(np.rint(sheet), 0, 255).astype(np.uint8)
+
+
+# ==============================
+# 🔥 ウォームアップ
+# ==============================
+def warm_up():
+    """初回の診断で払う準備（LUT の構築・顔検出器と skimage の読み込み）を先に済ませる
+
+    小さな合成画像で分析の各経路を 1 度ずつ通す。アプリの起動画面を表示している間に
+    バックグラウンドのスレッドから呼ぶ想定（何度呼んでもよい）。
+    """
+    img_bgr = np.empty((64, 64, 3), dtype=np.uint8)
+    img_bgr[:] = (120, 150, 200)        # 肌色に近い BGR
+    img_bgr[::2] = (60, 80, 110)        # 画質チェック用に縞を入れる
+    analyze_image_for_color(img_bgr, quality_gate=False)
+    check_image_quality(img_bgr)
+    detect_faces(img_bgr)
+    dominant_colors(img_bgr, k=2)
+
+
+# ==============================
+# 🧪 プロファイル用エントリポイント
+# ==============================
+def main(argv=None):
+    """python -m color_analyzer --profile <画像> [-n 回数] [--cprofile [出力先]]
+       python -m color_analyzer --benchmark-skin <画像> [<画像> ...]
+       python -m color_analyzer --live <カメラ番号または動画> [--fps N]
+       python -m color_analyzer --video <動画> [--face-roi]
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m color_analyzer", description="肌色分析の段階別プロファイル")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--profile", metavar="IMAGE", help="計測に使う画像ファイル")
+    target.add_argument("--benchmark-skin", metavar="IMAGE", nargs="+",
+                        help="肌抽出バックエンドの速度と一致度を比べる画像ファイル")
+    target.add_argument("--live", metavar="SOURCE", help="カメラ番号または動画ファイルをライブ分析する")
+    target.add_argument("--video", metavar="VIDEO", help="動画ファイルを（一部のフレームだけ読んで）分析する")
+    parser.add_argument("--fps", type=float, default=10.0, help="--live で分析する最大フレームレート（既定 10）")
+    parser.add_argument("-n", "--iterations", type=int, default=10, help="計測回数（既定 10）")
+    parser.add_argument("--mode", default="pixels", choices=["pixels", "histogram", "progressive"])
+    parser.add_argument("--lab-engine", default="lut", choices=["lut", "skimage"])
+    parser.add_argument("--max-pixels", type=int, default=None)
+    parser.add_argument("--face-roi", action="store_true")
+    parser.add_argument("--skin-backend", default="ycrcb", choices=list(SKIN_BACKENDS))
+    parser.add_argument("--cprofile", nargs="?", const="-", metavar="OUT",
+                        help="cProfile を有効にする（OUT を指定すると .prof を保存、省略で上位を表示）")
+    args = parser.parse_args(argv)
+    if args.iterations < 1:
+        parser.error("-n / --iterations は 1 以上を指定してください")
+
+    if args.benchmark_skin:
+        images = [cv2.imread(path, cv2.IMREAD_COLOR) for path in args.benchmark_skin]
+        if any(img is None for img in images):
+            parser.error("読み込めない画像があります")
+        report = benchmark_skin_backends(images, repeat=max(1, args.iterations))
+        print(f"{'backend':<12}{'MP/s':>10}{'coverage':>10}")
+        for name, row in report["backends"].items():
+            print(f"{name:<12}{row['mpix_per_s']:>10.1f}{row['coverage']:>10.1%}")
+        print(f"{'pair':<24}{'pixel':>8}{'IoU':>8}")
+        for (a, b), row in report["agreement"].items():
+            print(f"{a + ' / ' + b:<24}{row['pixel']:>8.1%}{row['iou']:>8.1%}")
+        return
+
+    if args.live is not None:
+        source = int(args.live) if args.live.isdigit() else args.live
+        live = LiveAnalyzer(target_fps=args.fps, skin_backend=args.skin_backend)
+        source_fps = None
+        if not isinstance(source, int):
+            # 動画ファイルは再生時刻で間引く（読むのは実時間より速いため）
+            capture = cv2.VideoCapture(source)
+            source_fps = capture.get(cv2.CAP_PROP_FPS) or None
+            capture.release()
+        for result in live.run(camera_frames(source), source_fps=source_fps):
+            print(f"{result['analyzed']:>6} {result['season']:<8} LAB={np.round(result['mean_lab'], 2)}"
+                  f"  skipped={result['skipped']}")
+        return
+
+    if args.video is not None:
+        info = {}
+        start = time.perf_counter()
+        season, mean_lab, _ = analyze_video_for_color(args.video, face_roi=args.face_roi,
+                                                      skin_backend=args.skin_backend, info=info)
+        print(f"result: {season}  LAB={np.round(mean_lab, 2)}  ({(time.perf_counter() - start) * 1000:.0f} ms)")
+        print(f"frames decoded: {info['frames_decoded']} / {info['frame_count']}"
+              f"  converged={info['converged']}  frames={info['frame_indices']}")
+        return
+
+    img_bgr = cv2.imread(args.profile, cv2.IMREAD_COLOR)
+    if img_bgr is None:
+        parser.error(f"画像を読み込めません: {args.profile}")
+    options = dict(mode=args.mode, lab_engine=args.lab_engine, max_pixels=args.max_pixels,
+                   face_roi=args.face_roi, skin_backend=args.skin_backend)
+
+    # 初回だけかかる LUT 構築などは時間の計測から外す。確保バイト数はこの初回の実行で
+    # tracemalloc を使って測る（LUT 構築の確保も含めるため。時間の計測とは分ける）
+    memory = StageTimings(trace_memory=True)
+    start = time.perf_counter()
+    try:
+        analyze_image_for_color(img_bgr, timings=memory, **options)
+    finally:
+        memory.stop()
+    print(f"warm-up: {(time.perf_counter() - start) * 1000:.1f} ms  ({img_bgr.shape[1]}x{img_bgr.shape[0]})")
+    allocated = {}
+    for stage in memory.stages:
+        allocated[stage["stage"]] = max(allocated.get(stage["stage"], 0), stage["bytes"])
+
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    runs = []
+    for _ in range(args.iterations):
+        timings = StageTimings()
+        result = analyze_image_for_color(img_bgr, timings=timings, **options)
+        runs.append(timings)
+
+    if profiler is not None:
+        profiler.disable()
+
+    # --- 段階ごとの平均・最小 ---
+    print(f"result: {result[0]}  LAB={np.round(result[1], 2)}")
+    print(f"{'stage':<16}{'mean ms':>10}{'min ms':>10}{'pixels':>12}{'MB (1st)':>10}")
+    for i, stage in enumerate(runs[0].stages):
+        if stage["stage"] == "start":
+            continue
+        seconds = [run.stages[i]["seconds"] for run in runs]
+        pixels = "" if stage["pixels"] is None else f"{stage['pixels']:,}"
+        mb = f"{allocated[stage['stage']] / 1e6:.2f}" if stage["stage"] in allocated else ""
+        print(f"{stage['stage']:<16}{np.mean(seconds) * 1000:>10.2f}{np.min(seconds) * 1000:>10.2f}"
+              f"{pixels:>12}{mb:>10}")
+    totals = [run.total_seconds for run in runs]
+    print(f"{'total':<16}{np.mean(totals) * 1000:>10.2f}{np.min(totals) * 1000:>10.2f}")
+    if runs[0].skin_coverage is not None:
+        print(f"skin coverage: {runs[0].skin_coverage:.1%}")
+
+    if profiler is not None:
+        if args.cprofile == "-":
+            import pstats
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        else:
+            profiler.dump_stats(args.cprofile)
+            print(f"cProfile: {args.cprofile}")
+
+
+if __name__ == "__main__":
+    main()
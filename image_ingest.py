@@ -0,0 +1,96 @@
+import struct
+
+import cv2
+import numpy as np
+
+from color_analyzer import RECOMMENDED_MAX_PIXELS
+
+# これを超える画素数の画像はデコード前に拒否する（解凍爆弾対策）
+MAX_IMAGE_PIXELS = 50_000_000
+
+# 縮小デコードのモード（縮小率 → imread フラグ）
+_REDUCED_MODES = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+# JPEG の SOF マーカー（DHT=C4, JPG=C8, DAC=CC を除く）
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class ImageRejectedError(ValueError):
+    """デコードせずに拒否した画像（大きすぎる・壊れている・JPEG / PNG でない）"""
+
+
+def probe_image_size(data):
+    """JPEG / PNG のヘッダーだけを読んで (幅, 高さ) を返す（不明な形式は None）"""
+    data = memoryview(data)
+
+    # --- PNG: シグネチャ直後の IHDR に幅・高さ ---
+    if bytes(data[:8]) == b"\x89PNG\r\n\x1a\n" and bytes(data[12:16]) == b"IHDR":
+        return struct.unpack(">II", data[16:24])
+
+    # --- JPEG: SOF セグメントまでマーカーをたどる ---
+    if bytes(data[:2]) == b"\xff\xd8":
+        i = 2
+        while i + 4 <= len(data):
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            if marker == 0xFF:  # 詰め物の 0xFF
+                i += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # 長さを持たないマーカー
+                i += 2
+                continue
+            if marker in (0xD9, 0xDA):  # EOI / SOS まで SOF がない
+                return None
+            (length,) = struct.unpack(">H", data[i + 2:i + 4])
+            if marker in _JPEG_SOF_MARKERS:
+                if i + 9 > len(data):
+                    return None
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return width, height
+            i += 2 + length
+
+    return None
+
+
+def choose_imread_flag(size, target_pixels):
+    """縮小後も target_pixels 以上残る最大の縮小率の imread フラグ"""
+    if size is None or not target_pixels:
+        return cv2.IMREAD_COLOR
+    width, height = size
+    for factor, flag in _REDUCED_MODES:
+        if (width // factor) * (height // factor) >= target_pixels:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode_upload(data, target_pixels=RECOMMENDED_MAX_PIXELS, max_pixels=MAX_IMAGE_PIXELS):
+    """アップロードされたバイト列 → BGR 画像
+
+    ヘッダーから寸法を読み、max_pixels を超えるものはメモリを確保する前に拒否する。
+    寸法を読めない画像（JPEG / PNG 以外や、SOF までたどれない JPEG）は大きさを確かめられないので、
+    OpenCV に渡さずに拒否する（WebP / TIFF などはヘッダーの寸法を見ずにデコードしてしまうため）。
+    JPEG は libjpeg の縮小デコード（1/2, 1/4, 1/8）で target_pixels に近い解像度まで
+    直接デコードするので、大きなスマホ写真でもピークメモリが 1 桁小さくなる。
+    （PNG は OpenCV が等倍でデコードしてから縮小するため、メモリ削減は拒否判定のみ）
+    """
+    size = probe_image_size(data)
+    if size is None:
+        raise ImageRejectedError("画像を読み込めませんでした（JPEG / PNG を選んでください）")
+    if size[0] * size[1] > max_pixels:
+        raise ImageRejectedError(
+            f"画像が大きすぎます（{size[0]}x{size[1]}、上限 {max_pixels:,} 画素）"
+        )
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    try:
+        img_bgr = cv2.imdecode(buf, choose_imread_flag(size, target_pixels))
+    except cv2.error:
+        img_bgr = None
+    if img_bgr is None:
+        raise ImageRejectedError("画像を読み込めませんでした（JPEG / PNG を選んでください）")
+    return img_bgr
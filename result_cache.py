@@ -0,0 +1,273 @@
+import hashlib
+import inspect
+import json
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import color_analyzer
+from image_ingest import MAX_IMAGE_PIXELS, decode_upload, probe_image_size
+
+
+# 分析の処理（LUT の形式・既定のオプション・品質チェックなど）を変えて結果が変わるときに上げる
+CACHE_VERSION = 1
+
+# 結果に影響しない（キーに含めない）analyze_image_for_color の引数
+_UNKEYED_OPTIONS = {"img_bgr", "info", "timings"}
+
+
+def _normalized_options(options):
+    """analyze_image_for_color の既定値に呼び出し側の指定を重ねた、キー用の (名前, 値) のリスト
+
+    既定値を省略した呼び出しと明示した呼び出しが同じキーになるようにする。
+    SkinSegmenter は名前で表す（repr はオブジェクトのアドレスで、再起動するとヒットしなくなるため）。
+    """
+    parameters = inspect.signature(color_analyzer.analyze_image_for_color).parameters
+    merged = {name: p.default for name, p in parameters.items() if name not in _UNKEYED_OPTIONS}
+    merged.update((name, value) for name, value in (options or {}).items() if name not in _UNKEYED_OPTIONS)
+    backend = merged.get("skin_backend")
+    if isinstance(backend, color_analyzer.SkinSegmenter):
+        merged["skin_backend"] = backend.name
+    return sorted(merged.items())
+
+
+def analyzer_fingerprint(options=None):
+    """診断結果に影響する設定のハッシュ → "<処理と設定>-<分析オプション>"
+
+    前半は CACHE_VERSION・肌しきい値・品質チェックのしきい値・画像の画素数上限・SEASONS パレット、
+    後半は既定値で補った分析オプション。SEASONS などは呼び出し時点の値を読むので、
+    パレットを変えるとキーが変わり、古い結果には二度とヒットしなくなる
+    （メモリ上は LRU で追い出され、ディスク上は ResultCache が前半の違うディレクトリを削除する）。
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update(f"v{CACHE_VERSION}".encode())
+    h.update(color_analyzer.SKIN_YCRCB_LOWER.tobytes())
+    h.update(color_analyzer.SKIN_YCRCB_UPPER.tobytes())
+    h.update(str(color_analyzer.MIN_SKIN_PIXELS).encode())
+    h.update(repr((
+        color_analyzer.QUALITY_CHECK_SIZE, color_analyzer.QUALITY_MIN_BRIGHTNESS,
+        color_analyzer.QUALITY_MAX_CLIPPED, color_analyzer.QUALITY_MIN_SHARPNESS,
+        color_analyzer.QUALITY_MIN_SKIN, MAX_IMAGE_PIXELS,
+    )).encode())
+    for name, palette in color_analyzer.SEASONS.items():
+        h.update(name.encode())
+        h.update(np.asarray(palette, dtype=np.float64).tobytes())
+    options_hash = hashlib.blake2b(repr(_normalized_options(options)).encode(), digest_size=8)
+    return f"{h.hexdigest()}-{options_hash.hexdigest()}"
+
+
+def content_hash(data):
+    """アップロードされたバイト列のハッシュ（blake2b は標準ライブラリで最速クラス）"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def image_signature(data):
+    """アップロードされたバイト列 → (64bit dHash, 画像全体の平均 LAB)（デコードできなければ None）
+
+    decode_upload と同じく、ヘッダーから寸法を読めない画像や大きすぎる画像はデコードしない。
+    JPEG は 1/8 縮小のカラーで直接デコードするので、通常のデコードよりずっと安い。
+    dHash は 9x8 に縮小し、横に隣り合う画素の明暗の大小をビットにしたもの。
+    dHash は明るさや色かぶりに反応しないので、撮り直しで光の色が変わったことは平均 LAB で見分ける。
+    """
+    size = probe_image_size(data)
+    if size is None or size[0] * size[1] > MAX_IMAGE_PIXELS:
+        return None
+    try:
+        small = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_COLOR_8)
+    except cv2.error:
+        small = None
+    if small is None:
+        return None
+    gray = cv2.resize(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (9, 8), interpolation=cv2.INTER_AREA)
+    bits = gray[:, 1:] > gray[:, :-1]
+    phash = int.from_bytes(np.packbits(bits).tobytes(), "big")
+    mean_bgr = np.rint(cv2.mean(small)[:3]).astype(np.uint8).reshape(1, 3)
+    mean_lab = color_analyzer._bgr_to_lab_float32(mean_bgr)[0].astype(np.float64)
+    return phash, mean_lab
+
+
+def perceptual_hash(data):
+    """アップロードされたバイト列の 64bit dHash（デコードできなければ None）"""
+    signature = image_signature(data)
+    return None if signature is None else signature[0]
+
+
+class NearDuplicateCache:
+    """知覚ハッシュが近く（ハミング距離 ≤ max_distance）、画像全体の平均 LAB も近い
+    （ΔE76 ≤ max_delta_e）画像の診断結果を返すキャッシュ
+
+    マルチインデックスハッシュ: 64bit を max_distance + 1 個の区間に分けると、
+    距離が max_distance 以下の 2 つのハッシュはどれかの区間が必ず完全一致する（鳩の巣原理）。
+    区間ごとの辞書で候補を引き、候補だけ距離を測るので、件数が増えても検索はほぼ O(1)。
+    """
+
+    def __init__(self, max_distance=5, max_entries=512, max_delta_e=2.0):
+        self.max_distance = max_distance
+        self.max_delta_e = max_delta_e
+        self.max_entries = max_entries
+        n_chunks = max_distance + 1
+        bounds = [64 * i // n_chunks for i in range(n_chunks + 1)]
+        self._chunks = list(zip(bounds[:-1], bounds[1:]))
+        self._tables = [{} for _ in self._chunks]
+        self._entries = OrderedDict()   # (fingerprint, phash, 丸めた平均 LAB) → (平均 LAB, 結果)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _chunk_values(self, phash):
+        return [(phash >> (64 - end)) & ((1 << (end - start)) - 1) for start, end in self._chunks]
+
+    def get(self, phash, fingerprint, mean_lab):
+        with self._lock:
+            for table, value in zip(self._tables, self._chunk_values(phash)):
+                for key in table.get(value, ()):
+                    if key[0] != fingerprint or bin(key[1] ^ phash).count("1") > self.max_distance:
+                        continue
+                    stored_lab, result = self._entries[key]
+                    if np.linalg.norm(stored_lab - mean_lab) <= self.max_delta_e:
+                        self._entries.move_to_end(key)
+                        self.stats["hits"] += 1
+                        return result
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, phash, fingerprint, mean_lab, result):
+        # 同じ dHash でも色が違えば別の結果として持つ
+        key = (fingerprint, phash, tuple(np.round(mean_lab, 1)))
+        with self._lock:
+            if key not in self._entries:
+                for table, value in zip(self._tables, self._chunk_values(phash)):
+                    table.setdefault(value, set()).add(key)
+            self._entries[key] = (np.asarray(mean_lab, dtype=np.float64), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                for table, value in zip(self._tables, self._chunk_values(old_key[1])):
+                    bucket = table[value]
+                    bucket.discard(old_key)
+                    if not bucket:
+                        del table[value]
+                self.stats["evictions"] += 1
+
+
+class ResultCache:
+    """analyze_image_for_color の結果キャッシュ（メモリ LRU ＋ 任意のディスク層）
+
+    キーは「画像バイト列のハッシュ」と「analyzer_fingerprint」の組。
+    ディスク層は disk_dir/<処理と設定>/<分析オプション>/<content_hash>.json に保存し、再起動後も使える。
+    ある「処理と設定」のハッシュで初めて書くときに、それ以外のハッシュのディレクトリ
+    （パレットの調整や更新で二度とヒットしなくなった結果）を削除する。
+    near_duplicates に NearDuplicateCache を渡すと、完全一致しなくても
+    ほぼ同じ写真（カメラで同じポーズを撮り直したものなど）の結果を返す。
+    複数セッション（スレッド）から共有してよい。
+    """
+
+    def __init__(self, max_entries=256, disk_dir=None, near_duplicates=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.near_duplicates = near_duplicates
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruned_for = None
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def _disk_path(self, key):
+        fingerprint, digest = key
+        return os.path.join(self.disk_dir, *fingerprint.split("-", 1), digest + ".json")
+
+    def _prune_disk(self, fingerprint):
+        """disk_dir から、いまの「処理と設定」のハッシュ以外のディレクトリを削除する"""
+        current = fingerprint.split("-", 1)[0]
+        with self._lock:
+            if self._pruned_for == current:
+                return
+            self._pruned_for = current
+        try:
+            names = os.listdir(self.disk_dir)
+        except OSError:
+            return
+        for name in names:
+            # analyzer_fingerprint が作る名前（16 桁の 16 進）だけを対象にする
+            if name != current and re.fullmatch(r"[0-9a-f]{16}", name):
+                shutil.rmtree(os.path.join(self.disk_dir, name), ignore_errors=True)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._entries[key]
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), encoding="utf-8") as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                record = None
+            if record is not None:
+                result = (record["season"], np.array(record["mean_lab"]), record["percentages"])
+                self._remember(key, result)
+                with self._lock:
+                    self.stats["disk_hits"] += 1
+                return result
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.disk_dir:
+            season, mean_lab, percentages = result
+            record = {
+                "season": season,
+                "mean_lab": [float(v) for v in mean_lab],
+                "percentages": {k: float(v) for k, v in percentages.items()},
+            }
+            self._prune_disk(key[0])
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 書きかけのファイルを読まれないよう、一時ファイルから置き換える
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def analyze_bytes(self, data, **options):
+        """アップロードされたバイト列を（キャッシュがなければ）デコードして診断"""
+        key = (analyzer_fingerprint(options), content_hash(data))
+        result = self.get(key)
+        if result is not None:
+            return result
+
+        signature = None
+        if self.near_duplicates is not None:
+            signature = image_signature(data)
+            if signature is not None:
+                result = self.near_duplicates.get(signature[0], key[0], signature[1])
+
+        if result is None:
+            result = color_analyzer.analyze_image_for_color(decode_upload(data), **options)
+            if signature is not None:
+                self.near_duplicates.put(signature[0], key[0], signature[1], result)
+        self.put(key, result)
+        return result
+
+
+# プロセス全体で共有するキャッシュ（環境変数でディスク層の保存先を指定できる）
+shared_cache = ResultCache(
+    disk_dir=os.environ.get("PERSONAL_COLOR_CACHE_DIR"),
+    near_duplicates=NearDuplicateCache(),
+)
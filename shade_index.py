@@ -0,0 +1,253 @@
+import csv
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from skimage import color
+
+# インデックスの形式（変えたら上げる。古いインデックスは作り直す）
+SHADE_INDEX_VERSION = 1
+
+# LAB 空間を区切る格子（1 セルの一辺、ΔE76 単位）と各軸の範囲
+SHADE_GRID_CELL = 4.0
+SHADE_GRID_LOWER = np.array([0.0, -128.0, -128.0], dtype=np.float32)
+SHADE_GRID_UPPER = np.array([100.0, 128.0, 128.0], dtype=np.float32)
+
+
+def _hex_to_lab(hex_colors):
+    """"#RRGGBB" のリスト → (N, 3) の LAB（float32）"""
+    rgb = np.array(
+        [[int(h.lstrip("#")[i:i + 2], 16) for i in (0, 2, 4)] for h in hex_colors],
+        dtype=np.float64,
+    ) / 255.0
+    return color.rgb2lab(rgb.reshape(-1, 1, 3)).reshape(-1, 3).astype(np.float32)
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def _lab_to_hex(labs):
+    rgb = color.lab2rgb(np.asarray(labs, dtype=np.float64).reshape(-1, 1, 3)).reshape(-1, 3)
+    rgb = np.clip(np.rint(rgb * 255), 0, 255).astype(int)
+    return ["#%02X%02X%02X" % tuple(c) for c in rgb]
+
+
+def read_shade_catalogue(path):
+    """CSV のコスメ色カタログ → (名前, カテゴリ, LAB, HEX)
+
+    列は name, category と、L, a, b または hex のどちらか（両方あれば LAB を使う）。
+    """
+    names, categories, labs, hexes = [], [], [], []
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        fields = set(reader.fieldnames or ())
+        has_lab = {"L", "a", "b"} <= fields
+        if not ({"name", "category"} <= fields and (has_lab or "hex" in fields)):
+            raise ValueError(f"カタログの列が足りません: {path}（name, category と L,a,b または hex）")
+        for row in reader:
+            names.append(row["name"])
+            categories.append(row["category"])
+            if has_lab:
+                labs.append([float(row["L"]), float(row["a"]), float(row["b"])])
+            hexes.append(row.get("hex") or "")
+
+    if not names:
+        raise ValueError(f"カタログが空です: {path}")
+    labs = np.array(labs, dtype=np.float32) if labs else _hex_to_lab(hexes)
+    missing = [i for i, h in enumerate(hexes) if not h]
+    if missing:
+        for i, h in zip(missing, _lab_to_hex(labs[missing])):
+            hexes[i] = h
+    return names, categories, labs, hexes
+
+
+class ShadeIndex:
+    """コスメ色カタログの最近傍インデックス（LAB の一様格子）
+
+    格子の各セルに入る色を（カテゴリ, セル）の順に並べ、cell_starts で各セルの範囲を引く（CSR 形式）。
+    問い合わせは問い合わせ色のセルから外側へ 1 層ずつ広げ、
+    k 番目の距離が「まだ見ていない層までの最短距離」以下になったら打ち切る（厳密な top-k）。
+    配列はすべて .npy で保存し、読み込みは mmap なので起動時にカタログ全体を読まない。
+    """
+
+    FILES = ("lab", "category", "cell_starts", "names", "hexes")
+
+    def __init__(self, lab, category, cell_starts, names, hexes, categories, source_hash=None):
+        self.lab = lab
+        self.category = category
+        self.cell_starts = cell_starts
+        self.names = names
+        self.hexes = hexes
+        self.categories = list(categories)
+        self.source_hash = source_hash
+        self._shape = np.ceil((SHADE_GRID_UPPER - SHADE_GRID_LOWER) / SHADE_GRID_CELL).astype(np.int64)
+        self._n_cells = int(np.prod(self._shape))
+
+    def __len__(self):
+        return len(self.lab)
+
+    def _cell_coords(self, labs):
+        coords = np.floor((np.asarray(labs, dtype=np.float32) - SHADE_GRID_LOWER) / SHADE_GRID_CELL)
+        return np.clip(coords.astype(np.int64), 0, self._shape - 1)
+
+    @classmethod
+    def build(cls, names, categories, labs, hexes, source_hash=None):
+        labs = np.ascontiguousarray(labs, dtype=np.float32)
+        category_names = sorted(set(categories))
+        code = {c: i for i, c in enumerate(category_names)}
+        category = np.array([code[c] for c in categories], dtype=np.uint16)
+
+        index = cls(labs, category, None, None, None, category_names, source_hash)
+        coords = index._cell_coords(labs)
+        cell = np.ravel_multi_index(coords.T, index._shape) + category.astype(np.int64) * index._n_cells
+        order = np.argsort(cell, kind="stable")
+        counts = np.bincount(cell, minlength=len(category_names) * index._n_cells)
+
+        index.lab = labs[order]
+        index.category = category[order]
+        index.cell_starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        index.names = np.array(names)[order]
+        index.hexes = np.array(hexes)[order]
+        return index
+
+    @classmethod
+    def from_catalogue(cls, path):
+        return cls.build(*read_shade_catalogue(path), source_hash=_file_hash(path))
+
+    def save(self, index_dir):
+        """index_dir に保存（一時ディレクトリに書いてから置き換える）"""
+        tmp_dir = f"{index_dir.rstrip(os.sep)}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in self.FILES:
+            np.save(os.path.join(tmp_dir, name + ".npy"), np.asarray(getattr(self, name)))
+        meta = {
+            "version": SHADE_INDEX_VERSION,
+            "cell": SHADE_GRID_CELL,
+            "categories": self.categories,
+            "source_hash": self.source_hash,
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(tmp_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        """保存したインデックスを mmap で開く（形式が違えば ValueError）"""
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != SHADE_INDEX_VERSION or meta.get("cell") != SHADE_GRID_CELL:
+            raise ValueError(f"インデックスの形式が違います: {index_dir}")
+        arrays = {name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r") for name in cls.FILES}
+        return cls(categories=meta["categories"], source_hash=meta.get("source_hash"), **arrays)
+
+    def query(self, lab, k=5, category=None):
+        """lab に近い順に最大 k 件 → (カタログ内の位置の配列, ΔE76 の配列)"""
+        lab = np.asarray(lab, dtype=np.float32).reshape(3)
+        if category is None:
+            codes = range(len(self.categories))
+        elif category in self.categories:
+            codes = [self.categories.index(category)]
+        else:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        center = self._cell_coords(lab)
+        total = sum(int(self.cell_starts[(c + 1) * self._n_cells] - self.cell_starts[c * self._n_cells])
+                    for c in codes)
+        k = min(k, total)
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # 問い合わせ色の、自分のセル内での位置（セル単位・0〜1）
+        offset = (lab - SHADE_GRID_LOWER) / SHADE_GRID_CELL - center
+        radius = 0
+        while True:
+            lo = np.maximum(center - radius, 0)
+            hi = np.minimum(center + radius, self._shape - 1)
+            idx = self._gather(codes, lo, hi)
+            covers_all = bool(np.all(lo == 0) and np.all(hi == self._shape - 1))
+            if len(idx) >= k or covers_all:
+                d = np.sqrt(((self.lab[idx] - lab) ** 2).sum(axis=1))
+                top = np.argpartition(d, k - 1)[:k] if len(d) > k else np.arange(len(d))
+                top = top[np.argsort(d[top], kind="stable")]
+                # 立方体の外にある色までの距離の下限（各面までの距離の最小）
+                bound = np.min(np.concatenate([
+                    np.where(center - radius > 0, offset + radius, np.inf),
+                    np.where(center + radius < self._shape - 1, radius + 1 - offset, np.inf),
+                ])) * SHADE_GRID_CELL
+                if covers_all or d[top[-1]] <= bound:
+                    return idx[top], d[top]
+            radius += 1
+
+    def _gather(self, codes, lo, hi):
+        """カテゴリ codes の、セル座標 lo..hi（両端含む）の立方体に入る色の位置"""
+        # 最後の軸（b）は連続しているので、(L, a) の組ごとに 1 区間になる
+        l_idx, a_idx = np.meshgrid(np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1), indexing="ij")
+        row = (l_idx.ravel() * self._shape[1] + a_idx.ravel()) * self._shape[2]
+        starts, stops = [], []
+        for c in codes:
+            base = c * self._n_cells + row
+            starts.append(self.cell_starts[base + lo[2]])
+            stops.append(self.cell_starts[base + hi[2] + 1])
+        starts = np.concatenate(starts)
+        lengths = np.concatenate(stops) - starts
+        keep = lengths > 0
+        starts, lengths = starts[keep], lengths[keep]
+        if not len(starts):
+            return np.empty(0, dtype=np.int64)
+        # 区間 [start, start + length) を 1 本の位置配列に並べる
+        shifts = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return np.arange(lengths.sum(), dtype=np.int64) + shifts
+
+    def shades(self, positions, distances):
+        """query の結果 → [{"name", "category", "hex", "lab", "delta_e"}, ...]"""
+        return [
+            {
+                "name": str(self.names[i]),
+                "category": self.categories[int(self.category[i])],
+                "hex": str(self.hexes[i]),
+                "lab": [float(v) for v in self.lab[i]],
+                "delta_e": float(d),
+            }
+            for i, d in zip(positions, distances)
+        ]
+
+    def recommend(self, mean_lab, palette=None, k=5, category=None):
+        """肌の平均 LAB と（あれば）シーズン代表色に近いコスメ色
+
+        → {"skin": [...], "palette": [...]}。palette 側は代表色ごとの top-k をまとめ、
+        同じ色は最も近い代表色との距離で 1 回だけ数えて近い順に k 件。
+        """
+        result = {"skin": self.shades(*self.query(mean_lab, k, category))}
+        if palette is not None:
+            best = {}
+            for ref in np.asarray(palette, dtype=np.float32).reshape(-1, 3):
+                for i, d in zip(*self.query(ref, k, category)):
+                    if int(i) not in best or d < best[int(i)]:
+                        best[int(i)] = d
+            nearest = sorted(best.items(), key=lambda item: item[1])[:k]
+            result["palette"] = self.shades([i for i, _ in nearest], [d for _, d in nearest])
+        return result
+
+
+def load_shade_index(catalogue_path, index_dir=None):
+    """カタログのインデックスを開く（なければ／カタログが変わっていれば作って保存する）
+
+    index_dir の既定はカタログと同じ場所の <カタログ名>.index。
+    """
+    if index_dir is None:
+        index_dir = os.path.splitext(catalogue_path)[0] + ".index"
+    try:
+        index = ShadeIndex.load(index_dir)
+        if index.source_hash == _file_hash(catalogue_path):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    ShadeIndex.from_catalogue(catalogue_path).save(index_dir)
+    return ShadeIndex.load(index_dir)
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import color_analyzer
+
+SKIN_STATS_VERSION = 1
+
+# 画像 ID の最大バイト数（既定は内容の blake2b 16 バイトの 16 進 = 32 文字）
+STATS_ID_BYTES = 64
+
+
+class SkinStatsStore:
+    """画像ごとの肌統計（肌画素数・LAB 平均・任意で粗い LAB ヒストグラム）の列指向ストア
+
+    ディレクトリの中に列ごとの生バイナリ（<列名>.bin）を追記していくだけの形式で、
+    読み出しは np.memmap なので数百万件でもファイル全体を読み込まない。
+    件数は各列を書き終えてから rows.json に書く（置き換えは一度に行う）ので、読む側は確定した件数までしか見ない。
+    追記の途中で落ちて列の末尾に書きかけの行が残っても、次の追記がその位置から上書きする。
+    開くだけではファイルを変更しないので、追記中のストアを別のプロセスが開いて読んでもよい（書くのは 1 プロセスだけ）。
+    SEASONS を調整したときは rescore() で画像をデコードし直さずに判定をやり直せる。
+    """
+
+    def __init__(self, path, hist_bins=None):
+        self.path = path
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("version") != SKIN_STATS_VERSION:
+                raise ValueError(f"統計ファイルの形式が違います: {path}")
+            if hist_bins is not None and hist_bins != meta["hist_bins"]:
+                raise ValueError(f"hist_bins が既存のストアと違います: {hist_bins} != {meta['hist_bins']}")
+            hist_bins = meta["hist_bins"]
+        else:
+            os.makedirs(path, exist_ok=True)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"version": SKIN_STATS_VERSION, "hist_bins": hist_bins}, f)
+
+        self.hist_bins = hist_bins
+        self.columns = {
+            "id": (np.dtype(f"S{STATS_ID_BYTES}"), ()),
+            "n_pixels": (np.dtype("<i8"), ()),
+            "skin_count": (np.dtype("<i8"), ()),
+            "mean_lab": (np.dtype("<f8"), (3,)),
+        }
+        if hist_bins:
+            self.columns["hist"] = (np.dtype("<u4"), (hist_bins,) * 3)
+        self._lock = threading.Lock()
+        self._length = self._committed_length()
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name + ".bin")
+
+    def _row_bytes(self, name):
+        dtype, shape = self.columns[name]
+        return dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+
+    def _committed_length(self):
+        """確定した件数（rows.json。なければ最短の列の行数）。ファイルは変更しない"""
+        length = min(
+            os.path.getsize(self._column_path(name)) // self._row_bytes(name)
+            if os.path.exists(self._column_path(name)) else 0
+            for name in self.columns
+        )
+        rows_path = os.path.join(self.path, "rows.json")
+        if os.path.exists(rows_path):
+            with open(rows_path, encoding="utf-8") as f:
+                length = min(length, json.load(f)["rows"])
+        return length
+
+    def _commit_length(self, length):
+        rows_path = os.path.join(self.path, "rows.json")
+        tmp_path = f"{rows_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"rows": length}, f)
+        os.replace(tmp_path, rows_path)
+
+    def refresh(self):
+        """ほかのプロセスが追記した分を読めるように件数を読み直す"""
+        self._length = self._committed_length()
+        return self._length
+
+    def repair(self):
+        """確定した件数より後ろの書きかけの行を切り捨てる（保守用。書く側のプロセスだけが呼ぶ）"""
+        with self._lock:
+            length = self._committed_length()
+            for name in self.columns:
+                column_path = self._column_path(name)
+                if os.path.exists(column_path) and os.path.getsize(column_path) > length * self._row_bytes(name):
+                    with open(column_path, "r+b") as f:
+                        f.truncate(length * self._row_bytes(name))
+            self._commit_length(length)
+            self._length = length
+        return length
+
+    def __len__(self):
+        return self._length
+
+    def append(self, image_id, sums, hist=None):
+        """1 画像分の SkinLabSums（とヒストグラム）を追記"""
+        encoded = image_id.encode("utf-8") if isinstance(image_id, str) else bytes(image_id)
+        if len(encoded) > STATS_ID_BYTES:
+            raise ValueError(f"画像 ID が長すぎます（{STATS_ID_BYTES} バイトまで）: {image_id!r}")
+        if self.hist_bins and hist is None:
+            raise ValueError("このストアにはヒストグラムが必要です（hist_bins を指定して measure_skin_stats を呼ぶ）")
+
+        row = {
+            "id": encoded,
+            "n_pixels": sums.n_pixels,
+            "skin_count": sums.skin_count,
+            "mean_lab": sums.mean_lab(),
+        }
+        if self.hist_bins:
+            row["hist"] = hist
+        with self._lock:
+            # 書きかけの行が残っていても確定した件数の位置から書くので、列の行がずれない
+            length = self._committed_length()
+            for name, (dtype, shape) in self.columns.items():
+                column_path = self._column_path(name)
+                with open(column_path, "r+b" if os.path.exists(column_path) else "wb") as f:
+                    f.seek(length * self._row_bytes(name))
+                    f.write(np.asarray(row[name], dtype=dtype).reshape(shape).tobytes())
+            self._commit_length(length + 1)
+            self._length = length + 1
+
+    def column(self, name):
+        """列を読み取り専用の memmap で返す（形は (件数, ...)）"""
+        dtype, shape = self.columns[name]
+        if self._length == 0:
+            return np.empty((0,) + shape, dtype=dtype)
+        return np.memmap(self._column_path(name), dtype=dtype, mode="r", shape=(self._length,) + shape)
+
+    def ids(self):
+        return [image_id.decode("utf-8") for image_id in self.column("id")]
+
+
+def rescore(store, season_model=None):
+    """保存した LAB 平均をシーズンモデルで判定し直す → (判定シーズン名の配列, 適合度 (N, S), シーズン名)"""
+    model = season_model or color_analyzer.default_season_model()
+    best, _, percentages = model.score(store.column("mean_lab"))
+    return np.array(model.names, dtype=object)[best], percentages, model.names
+
+
+def main(argv=None):
+    """python -m skin_stats collect <ストア> <画像> [<画像> ...] [--hist-bins N]
+       python -m skin_stats rescore <ストア> [--model モデル.json] [--csv 出力先]
+    """
+    import argparse
+    import csv
+
+    import cv2
+
+    parser = argparse.ArgumentParser(prog="python -m skin_stats", description="肌統計の保存と再判定")
+    commands = parser.add_subparsers(dest="command", required=True)
+    collect = commands.add_parser("collect", help="画像の肌統計をストアに追記する（登録済みの画像は飛ばす）")
+    collect.add_argument("store")
+    collect.add_argument("images", nargs="+")
+    collect.add_argument("--hist-bins", type=int, default=None, help="粗い LAB ヒストグラムのビン数（256 の約数）")
+    collect.add_argument("--max-pixels", type=int, default=color_analyzer.RECOMMENDED_MAX_PIXELS)
+    collect.add_argument("--skin-backend", default="ycrcb", choices=list(color_analyzer.SKIN_BACKENDS))
+    score = commands.add_parser("rescore", help="保存した統計をシーズンモデルで判定し直す")
+    score.add_argument("store")
+    score.add_argument("--model", default=None, help="SeasonModel の JSON（省略で現在の SEASONS）")
+    score.add_argument("--csv", default=None, help="画像 ID ごとの結果を書き出す CSV")
+    args = parser.parse_args(argv)
+
+    if args.command == "collect":
+        store = SkinStatsStore(args.store, hist_bins=args.hist_bins)
+        store.repair()
+        known = set(store.ids())
+        added = 0
+        for image_path in args.images:
+            with open(image_path, "rb") as f:
+                data = f.read()
+            image_id = hashlib.blake2b(data, digest_size=16).hexdigest()
+            if image_id in known:
+                continue
+            img_bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img_bgr is None:
+                print(f"読み込めません: {image_path}")
+                continue
+            sums, hist = color_analyzer.measure_skin_stats(
+                img_bgr, args.max_pixels, args.skin_backend, store.hist_bins
+            )
+            store.append(image_id, sums, hist)
+            known.add(image_id)
+            added += 1
+            print(f"{image_id}  {image_path}")
+        print(f"追加 {added} 件 / 合計 {len(store)} 件")
+        return
+
+    store = SkinStatsStore(args.store)
+    model = color_analyzer.SeasonModel.load(args.model) if args.model else None
+    start = time.perf_counter()
+    seasons, percentages, names = rescore(store, model)
+    elapsed = time.perf_counter() - start
+    print(f"{len(store):,} 件を {elapsed * 1000:.1f} ms で再判定")
+    values, counts = np.unique(seasons.astype(str), return_counts=True)
+    for name, count in zip(values, counts):
+        print(f"  {name:<16}{count:>10,}")
+
+    if args.csv:
+        with open(args.csv, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "season"] + list(names))
+            for image_id, season, row in zip(store.ids(), seasons, percentages):
+                writer.writerow([image_id, season] + [f"{v:.2f}" for v in row])
+
+
+if __name__ == "__main__":
+    main()